@@ -0,0 +1,318 @@
+"""Offline benchmarks of each stage of rendering an image, compared
+against a baseline so that performance changes can be checked.
+
+    poetry run python bench_framey.py
+    poetry run python bench_framey.py --update
+
+Upstream services are mocked. Without Chrome, screenshots are replaced
+by a blank image and the render_html stage is skipped.
+"""
+
+import argparse
+import importlib.resources
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import numpy as np
+import requests_mock
+from PIL import Image
+
+import framey
+from framey import TileDitherer, dither_image, encode_image, encode_png
+from framey import make_qrcode, render_html, scheduler, spotify, weather
+from framey.browser import BrowserPool, find_chrome
+from framey.cache import Cache, FileStore, LRUCache
+from framey.draw import draw_album, draw_weather
+from framey.spotify import Album, album_context, download_cover, make_html
+from framey.spotify_api import SpotifyClient
+from framey.weather import Location, make_weather_image, weather_data
+
+BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json"
+)
+# Fail if a stage's p50 is this much slower than the baseline.
+THRESHOLD = 0.25
+# Fail if importing framey.server takes longer, in seconds, as it
+# holds up starting every worker.
+IMPORT_BUDGET = 1.0
+COVER_URL = "http://example.com/cover.jpeg"
+LOCATION = Location("Berkeley, CA", 37.87159, -122.27275, "fahrenheit")
+FORECAST = {
+    "current_weather": {
+        "temperature": 61.3,
+        "windspeed": 9.8,
+        "weathercode": 2,
+        "is_day": 1,
+    },
+    "hourly": {"precipitation": [0.0] * 168},
+    "daily": {
+        "temperature_2m_max": [66.2],
+        "temperature_2m_min": [50.1],
+        "sunrise": ["2023-06-01T05:47"],
+        "sunset": ["2023-06-01T20:25"],
+    },
+    "daily_units": {"temperature_2m_max": "°F", "windspeed_10m_max": "km/h"},
+}
+TRACK = {
+    "is_playing": True,
+    "item": {
+        "album": {
+            "images": [{"url": COVER_URL}],
+            "artists": [{"name": "Daniel Case"}],
+            "name": "Engigstciak",
+            "release_date": "2000",
+            "external_urls": {"spotify": "http://example.org"},
+        }
+    },
+}
+
+
+class BlankBrowser:
+    """Stands in for Chrome, returning a blank screenshot."""
+
+    def __init__(self):
+        self.renders = 0
+
+    def alive(self):
+        return True
+
+    def screenshot(self, url, size, html=None, scale=1):
+        self.renders += 1
+        size = round(size[0] * scale), round(size[1] * scale)
+        return encode_png(Image.new("RGB", size, "white"))
+
+    def close(self):
+        pass
+
+
+def make_album() -> Album:
+    return Album(
+        title="Engigstciak",
+        artist="Daniel Case",
+        year="2000",
+        spotify_url="http://example.org",
+        discogs_url=None,
+        cover=COVER_URL,
+        credits=None,
+    )
+
+
+def search_discogs(query, type):
+    if type == "master":
+        return []
+    credit = SimpleNamespace(name="Someone", role="Producer")
+    return [SimpleNamespace(credits=[credit], url="http://d/1")]
+
+
+def fresh_caches(directory: str):
+    """Start a run with empty caches, so stages are timed cold."""
+    framey.QRCODE_CACHE = LRUCache(maxsize=64)
+    path = tempfile.mkdtemp(dir=directory)
+    spotify.DISCOGS_CACHE = Cache(os.path.join(path, "discogs.sqlite"))
+    spotify.COVER_STORE = FileStore(os.path.join(path, "covers"))
+    scheduler.SHARED_DIR = os.path.join(path, "rendered")
+    scheduler.RENDERED = scheduler.RenderedStore(
+        os.path.join(path, "rendered", "rendered.sqlite")
+    )
+    weather.FORECASTS.clear()
+    weather.ICONS = LRUCache(maxsize=32)
+    weather.ICON_STORE = FileStore(os.path.join(path, "icons"))
+
+
+def stages(chrome: bool):
+    """Each stage's name and a function running it once."""
+    with importlib.resources.path("framey", "discogs.png") as path:
+        embed = Image.open(path)
+        embed.load()
+    with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+        screenshot = Image.open(path).convert("RGB").resize((800, 480))
+    html = make_html(make_album())
+    context = album_context(make_album())
+    # The next screenshot differs in a small region, as when the
+    # weather temperature changes.
+    ditherer = TileDitherer()
+    ditherer.dither(screenshot)
+    changed = screenshot.copy()
+    changed.paste((0, 0, 0), (300, 100, 420, 160))
+
+    def serve_playing():
+        from framey.server import SCHEDULER, app
+
+        # Jobs are refreshed in the foreground, not by the scheduler.
+        SCHEDULER._pid = os.getpid()
+        SCHEDULER.jobs["playing"].rendered = None
+        response = app.test_client().get("/playing.jpeg")
+        assert response.status_code == 200
+
+    yield "make_qrcode", lambda: make_qrcode("http://example.org", embed, (0, 0, 0))
+    yield "download_cover", lambda: download_cover(make_album())
+    yield "make_html", lambda: make_html(make_album(), enhance=True)
+    if chrome:
+        yield "render_html", lambda: render_html(html)
+    yield "draw_album", lambda: draw_album(context)
+    yield "draw_weather", lambda: draw_weather(weather_data(LOCATION))
+    yield "dither_image", lambda: dither_image(screenshot)
+    yield "dither_changed_tiles", lambda: ditherer.dither(changed)
+    yield "encode_image", lambda: encode_image(screenshot, framey.JPEG_BUDGET)
+    yield "make_weather_image", lambda: make_weather_image(LOCATION)
+    yield "serve_playing", serve_playing
+    yield "import_server", import_time
+
+
+def import_time() -> float:
+    """Seconds taken to import framey.server in a new interpreter, as
+    measured by python -X importtime."""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import framey.server"],
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stderr
+    for line in output.splitlines():
+        _, _, cumulative, name = line.replace(":", "|").split("|")
+        if name.strip() == "framey.server":
+            return int(cumulative) / 1e6
+    raise RuntimeError("framey.server was not imported")
+
+
+def memory_status(field: str) -> int:
+    """A field of /proc/self/status in bytes, e.g. VmRSS."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            if name == field:
+                return int(value.split()[0]) * 1024
+    raise KeyError(field)
+
+
+def reset_peak_rss() -> Optional[int]:
+    """Reset the peak resident memory of this process, so that the
+    next stage's own peak can be read, returning the memory in use.
+    Only Linux can do this; elsewhere returns None."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return None
+    return memory_status("VmRSS")
+
+
+def peak_rss_growth(rss: Optional[int]) -> Optional[int]:
+    """Bytes the peak resident memory rose above rss, as returned by
+    reset_peak_rss, since it was reset."""
+    return None if rss is None else memory_status("VmHWM") - rss
+
+
+def count_temp_files() -> int:
+    return len(os.listdir(tempfile.gettempdir()))
+
+
+def benchmark(runs: int, chrome: bool) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="framey-bench-") as directory:
+        with requests_mock.Mocker() as mock:
+            with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+                with open(path, "rb") as f:
+                    mock.get(COVER_URL, content=f.read())
+            mock.get("https://api.open-meteo.com/v1/forecast", json=FORECAST)
+            icon = Image.new("RGBA", (200, 200), (255, 128, 0, 128))
+            mock.get(weather.CODES[2]["day"][1], content=encode_png(icon))
+            mock.get(
+                "https://api.spotify.com/v1/me/player/currently-playing", json=TRACK
+            )
+            fresh_caches(directory)
+            for name, stage in stages(chrome):
+                times = []
+                temp_files = 0
+                growth = None
+                for _ in range(runs):
+                    fresh_caches(directory)
+                    before = count_temp_files()
+                    rss = reset_peak_rss()
+                    started = time.perf_counter()
+                    stage()
+                    times.append(time.perf_counter() - started)
+                    temp_files = max(temp_files, count_temp_files() - before)
+                    if rss is not None:
+                        growth = max(growth or 0, peak_rss_growth(rss))
+                results[name] = {
+                    "p50": float(np.percentile(times, 50)),
+                    "p95": float(np.percentile(times, 95)),
+                    "peak_rss_growth": growth,
+                    "temp_files": temp_files,
+                }
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """The stages which are slower than in baseline by more than
+    threshold."""
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline and result["p50"] > baseline[name]["p50"] * (1 + threshold)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET)
+    parser.add_argument(
+        "--update", action="store_true", help="save the results as the baseline"
+    )
+    args = parser.parse_args()
+
+    try:
+        find_chrome()
+        chrome = True
+    except FileNotFoundError:
+        print("Chrome not found, screenshots are blank.")
+        framey.BROWSER_POOL = BrowserPool(factory=BlankBrowser)
+        chrome = False
+    spotify.DISCOGS_CLIENT = SimpleNamespace(search=search_discogs)
+    spotify.spotify_client = lambda: SpotifyClient(auth="token")
+
+    results = benchmark(args.runs, chrome)
+    # rss MiB is how far each stage raised the peak resident memory
+    # above what was in use before it, on Linux.
+    print(f"{'stage':20} {'p50 ms':>9} {'p95 ms':>9} {'rss MiB':>8} {'temp':>5}")
+    for name, result in results.items():
+        growth = result["peak_rss_growth"]
+        print(
+            f"{name:20} {result['p50'] * 1000:9.2f} {result['p95'] * 1000:9.2f}"
+            f" {'-' if growth is None else format(growth / 2 ** 20, '.1f'):>8}"
+            f" {result['temp_files']:5}"
+        )
+
+    if args.update:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return
+    failed = False
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        if slower:
+            print("Slower than the baseline: " + ", ".join(slower))
+            failed = True
+    seconds = import_time()
+    print(f"Importing framey.server takes {seconds * 1000:.0f} ms")
+    if seconds > args.import_budget:
+        print(f"Over the import budget of {args.import_budget * 1000:.0f} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
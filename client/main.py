@@ -76,6 +76,40 @@ def display_jpeg(filename):
     graphics.update()
 
 
+def display_raw(resp):
+    # Pixels are palette pens packed two to a byte, drawn a row at a
+    # time straight from the socket so neither the SD card nor a
+    # decoder is needed.
+    print("displaying raw")
+    graphics = PicoGraphics(DISPLAY)
+    width, height = graphics.get_bounds()
+    socket = resp.raw
+    row = bytearray(width // 2)
+    gc.collect()
+    for y in range(height):
+        view = memoryview(row)
+        while len(view):
+            read = socket.readinto(view)
+            if not read:
+                break
+            view = view[read:]
+        x = 0
+        while x < width:
+            pen = row[x // 2] >> 4 if x % 2 == 0 else row[x // 2] & 0x0F
+            start = x
+            x += 1
+            while (
+                x < width
+                and (row[x // 2] >> 4 if x % 2 == 0 else row[x // 2] & 0x0F) == pen
+            ):
+                x += 1
+            graphics.set_pen(pen)
+            graphics.pixel_span(start, y, x - start)
+    socket.close()
+    gc.collect()
+    graphics.update()
+
+
 def write_etag(resp):
     if "ETag" in resp.headers:
         print("writing etag")
@@ -101,12 +135,17 @@ try:
     network_connect() and gc.collect()
     mount_sd_card() and gc.collect()
     image = CONFIG.BUTTONS[button]
-    filename = "/sd/" + image
+    filename = "/sd/" + image.split("?")[0]
     url = CONFIG.ENDPOINT + image
+    if hasattr(CONFIG, "PROFILE"):
+        url += ("&" if "?" in url else "?") + "profile=" + CONFIG.PROFILE
     print("requesting " + url)
     resp = urequests.get(url, headers=build_headers())
     if resp.status_code == 304:
         print("image unchanged")
+    elif image.split("?")[0].endswith(".raw"):
+        display_raw(resp) and gc.collect()
+        write_etag(resp) and gc.collect()
     else:
         read_jpeg(resp, filename) and gc.collect()
         display_jpeg(filename) and gc.collect()
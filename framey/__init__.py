@@ -1,85 +1,458 @@
+import atexit
+import base64
+import hashlib
+import io
+import json
 import os
-import tempfile
-from typing import Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
 
-import hitherdither
-import qrcode
-import qrcode.image.svg
-from html2image import Html2Image
+import numpy as np
+import requests
 from PIL import Image
-from qrcode.image.styledpil import StyledPilImage
-from qrcode.image.styles.colormasks import SolidFillColorMask
+from requests.adapters import HTTPAdapter
+
+from framey import metrics
+from framey.browser import BrowserPool
+from framey.cache import MISSING, LRUCache
 
 USER_AGENT = "framey/0.1"
 HEADERS = {
     "User-Agent": USER_AGENT,
 }
-HTI = Html2Image()
+# Seconds to wait on upstream servers.
+TIMEOUT = 10
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=8))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=8))
+BROWSER_POOL = BrowserPool()
+atexit.register(BROWSER_POOL.close)
+# Finished QR code PNGs by url, color and embedded image.
+QRCODE_CACHE = LRUCache(maxsize=64)
+metrics.CACHES["qrcode"] = QRCODE_CACHE
+PALETTE = np.array(
+    [
+        [0x00, 0x00, 0x00],  # black  #000000
+        [0xFF, 0xFF, 0xFF],  # white  #FFFFFF
+        [0x00, 0xFF, 0x00],  # green  #00FF00
+        [0x00, 0x00, 0xFF],  # blue   #0000FF
+        [0x00, 0xFF, 0x00],  # red    #FF0000
+        [0xFF, 0xFF, 0x00],  # yellow #FFFF00
+        [0xFF, 0x80, 0x00],  # orange #FF8000
+        # [0xDC, 0xB4, 0xC8] # taupe? #DCB4C8
+    ],
+    "uint8",
+)
+# Bytes a JPEG may take up, for clients short of memory. JPEGs are
+# saved with default settings if this is unset. Each profile may have
+# its own, see jpeg_budget.
+JPEG_BUDGET = int(os.getenv("FRAMEY_JPEG_BUDGET", 0)) or None
+# Chroma subsampling to try under a budget, best first: 4:4:4, 4:2:0.
+JPEG_SUBSAMPLINGS = (0, 2)
+JPEG_MAX_QUALITY = 95
+# The size pages are laid out at, which is that of the 7.3" frame.
+LAYOUT_SIZE = (800, 480)
+
+
+@dataclass(frozen=True)
+class Profile:
+    """A display images are rendered for. All Inky Frames share
+    PALETTE."""
+
+    width: int
+    height: int
+    # Bytes the display's JPEGs may take up, see fit_jpeg.
+    jpeg_budget: Optional[int] = JPEG_BUDGET
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+
+def jpeg_budget(key: str) -> Optional[int]:
+    """The JPEG budget of the profile with key, set by e.g.
+    FRAMEY_JPEG_BUDGET_5_7 for "5.7", 0 for none, or else JPEG_BUDGET."""
+    budget = os.getenv("FRAMEY_JPEG_BUDGET_" + key.replace(".", "_"))
+    return JPEG_BUDGET if budget is None else int(budget) or None
+
+
+# Displays images are served for, with ?profile=<key>, the first is
+# the default. Set FRAMEY_PROFILES to a comma separated list of keys
+# to render for other displays, e.g. "7.3,5.7".
+ALL_PROFILES = {
+    key: Profile(width, height, jpeg_budget(key))
+    for key, (width, height) in {
+        "7.3": (800, 480),
+        "5.7": (600, 448),
+        "4.0": (640, 400),
+    }.items()
+}
+PROFILES = {
+    key: ALL_PROFILES[key] for key in os.getenv("FRAMEY_PROFILES", "7.3").split(",")
+}
+BAYER_ORDER = 8
+BAYER_THRESHOLDS = np.array([256 / 4, 256 / 4, 256 / 4], "uint8")
+# Side of the tiles TileDitherer hashes and dithers, a multiple of
+# BAYER_ORDER so that a tile dithers as it would in the whole image.
+DITHER_TILE = 64
+# Threads dithering the changed tiles of an image; 0 dithers them in
+# the calling thread.
+DITHER_THREADS = int(os.getenv("FRAMEY_DITHER_THREADS", 0))
+
+
+def state_etag(*parts) -> str:
+    """Build an ETag from the inputs an image is rendered from, so
+    that it can be known before rendering."""
+    state = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(state.encode("utf-8")).hexdigest()
+
+
+def encode_png(image: Image) -> bytes:
+    out = io.BytesIO()
+    image.save(out, format="PNG", compress_level=1)
+    return out.getvalue()
+
+
+def data_uri(data: bytes, mimetype: str = "image/png") -> str:
+    return f"data:{mimetype};base64," + base64.b64encode(data).decode("ascii")
+
 
+def image_data_uri(image: Image) -> str:
+    """Encode an image as a PNG data URI, for inlining into html."""
+    return data_uri(encode_png(image))
 
-def make_qrcode(url: Optional[str], embed_image: Image, color: tuple, tmpdir) -> str:
+
+class SolidFill:
+    """A qrcode colour mask filling the modules with front_color. It
+    gives the same image as qrcode's SolidFillColorMask, which calls
+    Python for every pixel, in one NumPy operation."""
+
+    back_color = (255, 255, 255)
+    has_transparency = False
+
+    def __init__(self, front_color: tuple):
+        self.front_color = tuple(front_color)
+
+    def initialize(self, styled_image, image: Image):
+        pass
+
+    def apply_mask(self, image: Image):
+        # Modules are drawn black on white.
+        pixels = np.array(image)
+        modules = (pixels[..., :3] == 0).all(axis=-1)
+        pixels[modules, :3] = self.front_color
+        image.paste(Image.fromarray(pixels, image.mode))
+
+
+def make_qrcode(url: Optional[str], embed_image: Image, color: tuple) -> str:
     """Build a QRcode for a url with an optionally embedded image in
-    the center and a given color. Will write image to the tmpdir and
-    return the image file name."""
+    the center and a given color. Returns the image as a data URI.
+    QR codes are cached in QRCODE_CACHE."""
     if url is None:
         return ""
-    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, border=0)
-    qr.add_data(url)
-    img = qr.make_image(
-        image_factory=StyledPilImage,
-        embeded_image=embed_image,
-        color_mask=SolidFillColorMask(front_color=color),
+    key = (url, tuple(color), id(embed_image))
+    cached = QRCODE_CACHE.get(key)
+    if cached is MISSING:
+        import qrcode
+        from qrcode.image.styledpil import StyledPilImage
+
+        with metrics.timed("qrcode"):
+            qr = qrcode.QRCode(
+                error_correction=qrcode.constants.ERROR_CORRECT_H, border=0
+            )
+            qr.add_data(url)
+            img = qr.make_image(
+                image_factory=StyledPilImage,
+                embeded_image=embed_image,
+                color_mask=SolidFill(color),
+            )
+            # Holding on to embed_image keeps its id from being reused
+            # while it is in the cache.
+            cached = (embed_image, encode_png(img))
+        QRCODE_CACHE.set(key, cached)
+    return data_uri(cached[1])
+
+
+def render_html(html: str, size: Tuple[int, int] = LAYOUT_SIZE) -> Image:
+    """Build an image from an html string, laid out at LAYOUT_SIZE and
+    scaled down to fit size, with white around it. Any images should
+    be inlined as data URIs."""
+    scale = min(size[0] / LAYOUT_SIZE[0], size[1] / LAYOUT_SIZE[1], 1)
+    with metrics.timed("screenshot"):
+        png = BROWSER_POOL.screenshot(
+            "about:blank", size=LAYOUT_SIZE, html=html, scale=scale
+        )
+    return fit_image(Image.open(io.BytesIO(png)), size)
+
+
+def fit_image(image: Image, size: Tuple[int, int]) -> Image:
+    """Scale an image down to fit size, centred on white."""
+    if image.size == size:
+        return image
+    scale = min(size[0] / image.size[0], size[1] / image.size[1], 1)
+    scaled = (round(image.size[0] * scale), round(image.size[1] * scale))
+    if scaled != image.size:
+        image = image.resize(scaled, Image.LANCZOS)
+    padded = Image.new("RGB", size, "white")
+    padded.paste(
+        image.convert("RGB"),
+        ((size[0] - scaled[0]) // 2, (size[1] - scaled[1]) // 2),
     )
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False, dir=tmpdir) as out:
-        img.save(out)
-        return os.path.basename(out.name)
+    return padded
+
+
+def html_renderer(
+    build: Callable[[], Optional[str]]
+) -> Callable[[Profile], Optional[Image.Image]]:
+    """A function rendering the html from build for a Profile, for a
+    scheduler Job. The html is built once, on first use, and shared
+    between profiles; if it is None there is nothing to render."""
+    built = []
+
+    def render(profile: Profile) -> Optional[Image.Image]:
+        if not built:
+            built.append(build())
+        if built[0] is None:
+            return None
+        return render_html(built[0], profile.size)
+
+    return render
 
 
-def render_image(html_dir: tempfile.TemporaryDirectory) -> Image:
+def image_renderer(
+    draw: Callable[[], Optional[Image.Image]]
+) -> Callable[[Profile], Optional[Image.Image]]:
+    """Like html_renderer, for an image drawn at LAYOUT_SIZE without a
+    browser, which is scaled to fit each profile."""
+    drawn = []
+
+    def render(profile: Profile) -> Optional[Image.Image]:
+        if not drawn:
+            with metrics.timed("draw"):
+                drawn.append(draw())
+        if drawn[0] is None:
+            return None
+        return fit_image(drawn[0], profile.size)
+
+    return render
+
+
+def render_image(html_dir) -> Image:
     """Build a jpeg image from html. File will be dithered to work
     from inky frame colors, sized to 800x480. Directory should include
     a file named index.html."""
-    with tempfile.NamedTemporaryFile(
-        suffix=".png", delete=False, dir=html_dir.name
-    ) as tmp:
-        HTI.output_path = html_dir.name
-        HTI.screenshot(
-            url="file:///" + os.path.join(html_dir.name, "index.html"),
-            save_as=os.path.basename(tmp.name),
-            size=(800, 480),
-        )
-        return Image.open(tmp.name)
+    png = BROWSER_POOL.screenshot(
+        "file://" + os.path.join(os.path.abspath(html_dir.name), "index.html"),
+        size=(800, 480),
+    )
+    return Image.open(io.BytesIO(png))
+
+
+def save_jpeg(image: Image, **settings) -> bytes:
+    out = io.BytesIO()
+    image.save(out, format="JPEG", **settings)
+    return out.getvalue()
+
+
+def fit_jpeg(image: Image, budget: int, hint: Optional[dict] = None):
+    """Find the highest quality, and then least subsampled, JPEG of
+    image of at most budget bytes. Returns it and its settings; if
+    nothing fits, the smallest we can do. hint, the settings found
+    for a previous image, is checked first as a module's images
+    usually compress alike, saving a search."""
+
+    def save(quality, subsampling):
+        return save_jpeg(image, quality=quality, subsampling=subsampling, optimize=True)
+
+    if hint is not None:
+        quality, subsampling = hint["quality"], hint["subsampling"]
+        data = save(quality, subsampling)
+        if len(data) <= budget and (
+            quality == JPEG_MAX_QUALITY or len(save(quality + 1, subsampling)) > budget
+        ):
+            return data, dict(hint, bytes=len(data))
+    best = None
+    for subsampling in JPEG_SUBSAMPLINGS:
+        # Binary search for the highest quality which fits.
+        low, high = 1, JPEG_MAX_QUALITY
+        while low <= high:
+            quality = (low + high) // 2
+            data = save(quality, subsampling)
+            if len(data) <= budget:
+                if best is None or quality > best[1]["quality"]:
+                    best = data, {"quality": quality, "subsampling": subsampling}
+                low = quality + 1
+            else:
+                high = quality - 1
+    if best is None:
+        subsampling = JPEG_SUBSAMPLINGS[-1]
+        best = save(1, subsampling), {"quality": 1, "subsampling": subsampling}
+    data, settings = best
+    return data, dict(settings, bytes=len(data))
+
+
+def encode_jpeg(indices: np.ndarray) -> bytes:
+    return save_jpeg(Image.fromarray(PALETTE[indices], "RGB"))
+
+
+def encode_indexed_png(indices: np.ndarray) -> bytes:
+    """A PNG using the palette, which compresses dithering well."""
+    image = Image.fromarray(indices, "P")
+    image.putpalette(PALETTE.flatten().tolist())
+    out = io.BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
 
+def encode_raw(indices: np.ndarray) -> bytes:
+    """The palette index of each pixel packed 4 bits per pixel, the
+    first pixel in the high bits, row by row. Indices match the
+    PicoGraphics pens of the Inky Frame."""
+    if indices.shape[1] % 2:
+        indices = np.pad(indices, ((0, 0), (0, 1)))
+    return ((indices[:, 0::2] << 4) | indices[:, 1::2]).tobytes()
 
-def dither_image_path(path):
-    """Dither an image file at path."""
-    image = Image.open(path)
-    dither_image_int(image).save(path)
+
+# Formats images are served in, with their mimetypes and encoders.
+FORMATS = {
+    "jpeg": ("image/jpeg", encode_jpeg),
+    "png": ("image/png", encode_indexed_png),
+    "raw": ("application/octet-stream", encode_raw),
+}
+
+
+def encode_image(
+    image,
+    jpeg_budget: Optional[int] = None,
+    jpeg_hint: Optional[dict] = None,
+    ditherer: Optional["TileDitherer"] = None,
+) -> Tuple[Optional[Dict[str, bytes]], Optional[dict]]:
+    """Dither an image, with ditherer if given, and encode it in each
+    of FORMATS for the frame. With a jpeg_budget the JPEG is fit to it
+    with fit_jpeg, whose settings are returned too."""
+    if image is None:
+        return None, None
+    with metrics.timed("dither"):
+        indices = dither_indices(image) if ditherer is None else ditherer.dither(image)
+    bodies, settings = {}, None
+    with metrics.timed("encode"):
+        for format, (_, encode) in FORMATS.items():
+            if format == "jpeg" and jpeg_budget is not None:
+                bodies[format], settings = fit_jpeg(
+                    Image.fromarray(PALETTE[indices], "RGB"), jpeg_budget, jpeg_hint
+                )
+            else:
+                bodies[format] = encode(indices)
+    return bodies, settings
 
 
 def dither_image(image):
     """Dither an image."""
-    # Need to save and reopen or hitherdither errors
-    tmpfile = tempfile.NamedTemporaryFile(suffix=".jpg")
-    tmpfile.seek(0)
-    image.convert("RGB").save(tmpfile)
-    image = Image.open(tmpfile)
-    return dither_image_int(image)
+    return dither_image_int(image.convert("RGB"))
+
+
+def bayer_index(n: int) -> np.ndarray:
+    """The Bayer index matrix with side n, a power of 2."""
+    if n == 2:
+        return np.array([[0, 2], [3, 1]])
+    smaller = 4 * bayer_index(n >> 1)
+    return np.block([[smaller, smaller + 2], [smaller + 3, smaller + 1]])
+
+
+# Amount added to each channel of a pixel before finding the nearest
+# palette colour, by position in the Bayer matrix.
+BAYER_OFFSETS = (
+    np.expand_dims((1 + bayer_index(BAYER_ORDER)) / (1 + BAYER_ORDER**2), axis=2)
+    * BAYER_THRESHOLDS
+)
+
+
+def dither_indices(image) -> np.ndarray:
+    """Ordered dither an image to the Inky palette, returning the
+    palette index of each pixel. Matches hitherdither's bayer_dithering
+    pixel for pixel."""
+    return dither_pixels(np.array(image.convert("RGB"), "uint8"))
+
+
+def dither_pixels(pixels: np.ndarray) -> np.ndarray:
+    """dither_indices of an array of RGB pixels, from a part of an
+    image whose top left is at a multiple of BAYER_ORDER."""
+    height, width = pixels.shape[:2]
+    reps = (-(-height // BAYER_ORDER), -(-width // BAYER_ORDER), 1)
+    pixels = pixels + np.tile(BAYER_OFFSETS, reps)[:height, :width]
+    best = np.full((height, width), np.inf)
+    indices = np.zeros((height, width), "uint8")
+    for i, colour in enumerate(PALETTE):
+        diff = pixels - colour
+        # Euclidean distance, computed the way np.linalg.norm does so
+        # that ties break identically.
+        distance = np.sqrt(np.add.reduce(diff * diff, axis=2))
+        closer = distance < best
+        indices[closer] = i
+        best[closer] = distance[closer]
+    return indices
+
+
+class TileDitherer:
+    """Dithers the images of one endpoint tile by tile, reusing the
+    tiles which have not changed since its last image, so that a
+    render where little changed is dithered in a fraction of the
+    time. Gives the same indices as dither_indices."""
+
+    def __init__(self, tile: int = DITHER_TILE, threads: int = DITHER_THREADS):
+        assert tile % BAYER_ORDER == 0
+        self.tile = tile
+        self.threads = threads
+        # The last image's tile hashes, and its indices.
+        self._hashes = {}
+        self._indices = None
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def dither(self, image) -> np.ndarray:
+        pixels = np.array(image.convert("RGB"), "uint8")
+        height, width = pixels.shape[:2]
+        with self._lock:
+            if self._indices is None or self._indices.shape != (height, width):
+                self._hashes = {}
+                self._indices = np.zeros((height, width), "uint8")
+            tiles, changed = 0, []
+            for y in range(0, height, self.tile):
+                for x in range(0, width, self.tile):
+                    tile = pixels[y : y + self.tile, x : x + self.tile]
+                    digest = hashlib.blake2b(tile.tobytes(), digest_size=16).digest()
+                    tiles += 1
+                    if self._hashes.get((y, x)) != digest:
+                        changed.append((y, x, tile, digest))
+            metrics.count(
+                "framey_cache_requests_total",
+                tiles - len(changed),
+                cache="dither_tile",
+                result="hit",
+            )
+            metrics.count(
+                "framey_cache_requests_total",
+                len(changed),
+                cache="dither_tile",
+                result="miss",
+            )
+            work = [tile for _, _, tile, _ in changed]
+            if self.threads > 1 and len(work) > 1:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.threads, thread_name_prefix="framey-dither"
+                    )
+                dithered = self._executor.map(dither_pixels, work)
+            else:
+                dithered = map(dither_pixels, work)
+            for (y, x, _, digest), tile_indices in zip(changed, dithered):
+                self._indices[y : y + self.tile, x : x + self.tile] = tile_indices
+                self._hashes[(y, x)] = digest
+            return self._indices.copy()
 
 
 def dither_image_int(image):
-    palette = hitherdither.palette.Palette(
-        [
-            0x000000,  # black  #000000
-            0xFFFFFF,  # white  #FFFFFF
-            0x00FF00,  # green  #00FF00
-            0x0000FF,  # blue   #0000FF
-            0x00FF00,  # red    #FF0000
-            0xFFFF00,  # yellow #FFFF00
-            0xFF8000,  # orange #FF8000
-            # 0xDCB4C8 # taupe? #DCB4C8
-        ]
-    )
-    return hitherdither.ordered.bayer.bayer_dithering(
-        image, palette, [256 / 4, 256 / 4, 256 / 4], order=8
-    ).convert("RGB")
+    return Image.fromarray(PALETTE[dither_indices(image)], "RGB")
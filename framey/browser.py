@@ -0,0 +1,293 @@
+"""A pool of long running headless Chrome instances, driven over the
+DevTools protocol, so that renders do not pay for a browser cold
+start."""
+
+import base64
+import itertools
+import json
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+import requests
+
+CHROME_NAMES = (
+    "chromium",
+    "chromium-browser",
+    "google-chrome",
+    "google-chrome-stable",
+    "chrome",
+)
+# Same flags html2image used, so screenshots look the same.
+CHROME_FLAGS = [
+    "--headless",
+    "--default-background-color=000000",
+    "--hide-scrollbars",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--disable-extensions",
+    "--remote-debugging-port=0",
+]
+STARTUP_TIMEOUT = 30
+RENDER_TIMEOUT = 30
+WAIT_FOR_LOAD = """
+new Promise((resolve) => {
+  if (document.readyState === "complete") {
+    resolve();
+  } else {
+    window.addEventListener("load", () => resolve());
+  }
+}).then(() => document.fonts.ready).then(() => true)
+"""
+
+
+class BrowserError(Exception):
+    pass
+
+
+def find_chrome() -> str:
+    """Return the path of a Chrome executable, preferring the CHROME
+    environment variable."""
+    executable = os.getenv("CHROME")
+    if executable is None:
+        executable = next(filter(None, map(shutil.which, CHROME_NAMES)), None)
+    if executable is None:
+        raise FileNotFoundError("Could not find a Chrome executable.")
+    return executable
+
+
+def chrome_available() -> bool:
+    try:
+        find_chrome()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class Browser:
+    """A single headless Chrome process with one page we take
+    screenshots of."""
+
+    def __init__(self, executable: Optional[str] = None):
+        self.renders = 0
+        self._ids = itertools.count(1)
+        self._events = []
+        self._profile = tempfile.TemporaryDirectory(prefix="framey-chrome-")
+        self._process = subprocess.Popen(
+            [
+                executable or find_chrome(),
+                *CHROME_FLAGS,
+                f"--user-data-dir={self._profile.name}",
+                "about:blank",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        import websocket
+
+        try:
+            self._socket = websocket.create_connection(
+                self._page_url(), timeout=RENDER_TIMEOUT, suppress_origin=True
+            )
+            self._call("Page.enable")
+        except Exception:
+            self.close()
+            raise
+
+    def _page_url(self) -> str:
+        """Wait for chrome to write out its debugging port, then find
+        the websocket url of the blank page it opened."""
+        port_file = os.path.join(self._profile.name, "DevToolsActivePort")
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise BrowserError("Chrome exited during startup.")
+            if os.path.exists(port_file):
+                with open(port_file) as f:
+                    port = f.readline().strip()
+                if port:
+                    targets = requests.get(
+                        f"http://127.0.0.1:{port}/json/list", timeout=STARTUP_TIMEOUT
+                    ).json()
+                    for target in targets:
+                        if target["type"] == "page":
+                            return target["webSocketDebuggerUrl"]
+            time.sleep(0.05)
+        raise BrowserError("Timed out waiting for Chrome to start.")
+
+    def _receive(self) -> dict:
+        message = json.loads(self._socket.recv())
+        if "method" in message:
+            self._events.append(message["method"])
+        return message
+
+    def _call(self, method: str, **params) -> dict:
+        """Send a DevTools command and wait for its result, noting any
+        events that arrive meanwhile."""
+        message_id = next(self._ids)
+        self._socket.send(
+            json.dumps({"id": message_id, "method": method, "params": params})
+        )
+        while True:
+            message = self._receive()
+            if message.get("id") == message_id:
+                if "error" in message:
+                    raise BrowserError(f"{method}: {message['error']}")
+                return message["result"]
+
+    def _wait_for(self, event: str):
+        while event not in self._events:
+            self._receive()
+
+    def alive(self) -> bool:
+        return self._process.poll() is None and self._socket.connected
+
+    def screenshot(
+        self,
+        url: str,
+        size: Tuple[int, int],
+        html: Optional[str] = None,
+        scale: float = 1,
+    ) -> bytes:
+        """Load url into the page, replacing its content with html if
+        given, and return a PNG screenshot of it. The page is laid out
+        at size and the screenshot scaled by scale."""
+        self._call(
+            "Emulation.setDeviceMetricsOverride",
+            width=size[0],
+            height=size[1],
+            deviceScaleFactor=scale,
+            mobile=False,
+        )
+        self._events.clear()
+        frame_id = self._call("Page.navigate", url=url)["frameId"]
+        self._wait_for("Page.loadEventFired")
+        if html is not None:
+            self._call("Page.setDocumentContent", frameId=frame_id, html=html)
+        self._call("Runtime.evaluate", expression=WAIT_FOR_LOAD, awaitPromise=True)
+        data = self._call("Page.captureScreenshot", format="png")["data"]
+        self.renders += 1
+        return base64.b64decode(data)
+
+    def close(self):
+        if getattr(self, "_socket", None) is not None:
+            self._socket.close()
+        if self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        self._profile.cleanup()
+
+
+class BrowserPool:
+    """Hands out warm browsers to threads, starting at most size of
+    them. Browsers which fail are thrown away and those which have
+    done max_renders screenshots are restarted, so a leaking or
+    crashed Chrome never sticks around. Each process (e.g. gunicorn
+    worker) gets its own browsers, started on first use."""
+
+    def __init__(self, size: int = 2, max_renders: int = 100, factory=Browser):
+        self.size = size
+        self.max_renders = max_renders
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        # Every browser this process started, idle or in use.
+        self._browsers = set()
+
+    def _start(self):
+        browser = self.factory()
+        with self._lock:
+            self._browsers.add(browser)
+        return browser
+
+    def _close(self, browser):
+        with self._lock:
+            self._browsers.discard(browser)
+        browser.close()
+
+    def _check_fork(self):
+        # Browsers started by a parent process belong to it.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    @contextmanager
+    def browser(self):
+        self._check_fork()
+        slots = self._slots
+        slots.acquire()
+        browser = None
+        try:
+            try:
+                browser = self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if browser is None or not browser.alive():
+                if browser is not None:
+                    self._close(browser)
+                browser = self._start()
+            yield browser
+        except Exception:
+            if browser is not None:
+                self._close(browser)
+                browser = None
+            raise
+        finally:
+            if browser is not None:
+                if browser.renders >= self.max_renders:
+                    self._close(browser)
+                else:
+                    self._idle.put(browser)
+            slots.release()
+
+    def screenshot(
+        self,
+        url: str,
+        size: Tuple[int, int],
+        html: Optional[str] = None,
+        scale: float = 1,
+        retries: int = 1,
+    ) -> bytes:
+        """Take a screenshot with a pooled browser, retrying with a
+        fresh browser if the one we got has died."""
+        from websocket import WebSocketException
+
+        for attempt in range(retries + 1):
+            try:
+                with self.browser() as browser:
+                    return browser.screenshot(url, size, html=html, scale=scale)
+            except (BrowserError, OSError, WebSocketException):
+                if attempt == retries:
+                    raise
+
+    def warm_up(self):
+        """Start a browser, so that the first screenshot need not."""
+        with self.browser():
+            pass
+
+    def close(self):
+        """Close every browser this process started, including those in
+        use. Chrome outlives the process which started it, so this is
+        run at exit."""
+        self._check_fork()
+        with self._lock:
+            browsers, self._browsers = self._browsers, set()
+            self._idle = queue.LifoQueue()
+        for browser in browsers:
+            browser.close()
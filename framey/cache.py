@@ -0,0 +1,158 @@
+"""Caches, in memory and ones which survive server restarts."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+CACHE_DIR = os.getenv(
+    "FRAMEY_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "framey")
+)
+# Returned by Cache.get for keys which are not cached, as None may be
+# a cached value.
+MISSING = object()
+
+
+class LRUCache:
+    """An in-memory cache of up to maxsize values, evicting the least
+    recently used, which counts its hits and misses."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                self._values.move_to_end(key)
+                return self._values[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+
+class SQLiteStore:
+    """Base for stores in a SQLite file, created with SCHEMA, which
+    can be shared by threads and processes."""
+
+    SCHEMA = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self) -> sqlite3.Connection:
+        # Connections may not be shared between threads or processes.
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(self.SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+
+class Cache(SQLiteStore):
+    """A key value store in a SQLite file. Values are anything JSON
+    can encode and expire after a TTL; beyond max_entries the least
+    recently used are evicted."""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS cache"
+        " (key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL)"
+    )
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        super().__init__(path)
+        self.max_entries = max_entries
+
+    def get(self, key: str, default=MISSING):
+        db = self._db()
+        now = time.time()
+        row = db.execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return default
+        db.execute("UPDATE cache SET used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float):
+        db = self._db()
+        now = time.time()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now),
+            )
+            db.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+            db.execute(
+                "DELETE FROM cache WHERE key IN"
+                " (SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+class FileStore:
+    """Files in a directory, named by a hash of their key. Once they
+    total more than max_bytes the least recently used are removed."""
+
+    def __init__(self, path: str, max_bytes: int = 100 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._file(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The modification time records when a file was last used.
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, data: bytes):
+        os.makedirs(self.path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, self._file(key))
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,156 @@
+"""Make a card for every album in a Spotify or Discogs library. Albums
+are fetched a page at a time and rendered by a pool of processes. The
+offset reached is saved after each page, so an interrupted run resumes
+where it stopped, and cards are named by the hash of what they are
+rendered from, so ones already made are skipped."""
+
+import json
+import logging
+import multiprocessing.util
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import framey
+from framey import PROFILES, dither_indices, encode_indexed_png, spotify
+from framey.browser import chrome_available
+from framey.spotify import Album, album_state, make_spotify_album
+
+logger = logging.getLogger(__name__)
+
+CARDS_DIR = os.getenv("FRAMEY_CARDS_DIR", "cards")
+PAGE_SIZE = 50
+# Pages rendered at once, so the pool has work while a page is fetched.
+PAGES_AHEAD = 2
+
+
+def spotify_pages(offset: int = 0) -> Iterator[Tuple[int, List[Album]]]:
+    """The user's saved albums from offset, a page at a time, with the
+    offset after each page."""
+    while True:
+        page = spotify.spotify_client().current_user_saved_albums(
+            limit=PAGE_SIZE, offset=offset
+        )
+        offset += len(page["items"])
+        yield offset, [make_spotify_album(item["album"]) for item in page["items"]]
+        if page["next"] is None:
+            return
+
+
+def make_discogs_album(release: dict) -> Album:
+    return Album(
+        cover=release["cover_image"],
+        artist=", ".join([artist["name"] for artist in release["artists"]]),
+        title=release["title"],
+        year=str(release["year"] or ""),
+        spotify_url=None,
+        discogs_url=f"https://www.discogs.com/release/{release['id']}",
+        credits=None,
+    )
+
+
+def discogs_pages(offset: int = 0) -> Iterator[Tuple[int, List[Album]]]:
+    """The albums in the user's Discogs collection from offset, a page
+    at a time, with the offset after each page."""
+    releases = spotify.discogs().identity().collection_folders[0].releases
+    releases.per_page = PAGE_SIZE
+    for index in range(offset // PAGE_SIZE + 1, releases.pages + 1):
+        items = releases.page(index)
+        offset += len(items)
+        yield offset, [
+            make_discogs_album(item.data["basic_information"]) for item in items
+        ]
+
+
+def start_worker():
+    # Workers exit without running atexit, so close their browsers as
+    # multiprocessing finalizes them.
+    multiprocessing.util.Finalize(None, framey.BROWSER_POOL.close, exitpriority=10)
+
+
+def make_card(album: Album, path: str, renderer: str):
+    """Render, dither and save the card of an album. Run in a worker
+    process."""
+    _, render = album_state(album, renderer)
+    image = render(next(iter(PROFILES.values())))
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), suffix=".tmp", delete=False
+    ) as f:
+        f.write(encode_indexed_png(dither_indices(image)))
+    os.replace(f.name, path)
+
+
+def read_progress(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, "progress.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_progress(directory: str, progress: dict):
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, suffix=".tmp", delete=False
+    ) as f:
+        json.dump(progress, f)
+    os.replace(f.name, os.path.join(directory, "progress.json"))
+
+
+def make_cards(
+    source: str,
+    pages,
+    directory: str = CARDS_DIR,
+    renderer: Optional[str] = None,
+    workers: Optional[int] = None,
+) -> int:
+    """Make the cards of the albums from pages, a function of the
+    offset to start at like spotify_pages, returning how many were
+    made. A card whose album has not changed since it was last made is
+    skipped. Once the albums run out the source's progress is cleared,
+    so that the next run checks for new ones."""
+    renderer = renderer or ("chrome" if chrome_available() else "pillow")
+    os.makedirs(directory, exist_ok=True)
+    progress = read_progress(directory)
+    made = 0
+    pending = deque()
+
+    def finish_page():
+        nonlocal made
+        offset, futures = pending.popleft()
+        for album, future in futures:
+            try:
+                future.result()
+                made += 1
+            except Exception:
+                logger.exception("Making the card of %s failed", album.title)
+        progress[source] = offset
+        write_progress(directory, progress)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker) as executor:
+        for offset, albums in pages(progress.get(source, 0)):
+            futures = []
+            for album in albums:
+                etag, _ = album_state(album, renderer)
+                path = os.path.join(directory, etag + ".png")
+                if not os.path.exists(path):
+                    futures.append(
+                        (album, executor.submit(make_card, album, path, renderer))
+                    )
+            pending.append((offset, futures))
+            while len(pending) >= PAGES_AHEAD:
+                finish_page()
+        while pending:
+            finish_page()
+    progress.pop(source, None)
+    write_progress(directory, progress)
+    return made
+
+
+def make_spotify_cards(directory: str = CARDS_DIR, **kwargs) -> int:
+    return make_cards("spotify", spotify_pages, directory, **kwargs)
+
+
+def make_discogs_cards(directory: str = CARDS_DIR, **kwargs) -> int:
+    return make_cards("discogs", discogs_pages, directory, **kwargs)
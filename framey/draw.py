@@ -0,0 +1,141 @@
+"""Draw the now playing and weather cards with Pillow, laid out like
+their html templates, for rendering without Chrome."""
+
+import base64
+import io
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from framey import LAYOUT_SIZE, PALETTE
+
+# Fonts to look for, by Pillow in the system's font directories, in
+# order of preference. Pillow's own font is used if none are found.
+FONTS = ("IBMPlexMono-Regular.ttf", "DejaVuSansMono.ttf", "LiberationMono-Regular.ttf")
+BOLD_FONTS = (
+    "IBMPlexMono-Bold.ttf",
+    "DejaVuSansMono-Bold.ttf",
+    "LiberationMono-Bold.ttf",
+)
+SANS_FONTS = ("DejaVuSans.ttf", "LiberationSans-Regular.ttf") + FONTS
+# Indices of colours in PALETTE.
+BLACK, WHITE, BLUE = 0, 1, 3
+CHART_SIZE = (480, 80)
+# Millimetres of precipitation a full height bar stands for at least,
+# so that drizzle is not drawn as a downpour.
+CHART_MIN_SCALE = 2.0
+_fonts = {}
+
+
+def font(size: int, names=FONTS) -> ImageFont.ImageFont:
+    key = (size, names)
+    if key not in _fonts:
+        for name in names:
+            try:
+                _fonts[key] = ImageFont.truetype(name, size)
+                break
+            except OSError:
+                pass
+        else:
+            _fonts[key] = ImageFont.load_default()
+    return _fonts[key]
+
+
+def decode_data_uri(uri: str) -> Optional[Image.Image]:
+    if not uri:
+        return None
+    return Image.open(io.BytesIO(base64.b64decode(uri.split(",", 1)[1])))
+
+
+def wrap(
+    draw: ImageDraw.ImageDraw,
+    runs: List[Tuple[str, ImageFont.ImageFont]],
+    origin: Tuple[int, int],
+    width: int,
+    line_height: int,
+) -> int:
+    """Draw runs of text in their fonts, wrapping between words at
+    width like a browser. Returns the y below the last line."""
+    x, y = origin
+    for text, run_font in runs:
+        for word in text.split(" "):
+            if not word:
+                continue
+            space = draw.textlength(" ", font=run_font)
+            length = draw.textlength(word, font=run_font)
+            if x > origin[0] and x + length > origin[0] + width:
+                x, y = origin[0], y + line_height
+            draw.text((x, y), word, font=run_font, fill="black")
+            x += length + space
+    return y + line_height
+
+
+def draw_album(context: dict) -> Image.Image:
+    """Draw an album from the values of the now playing template."""
+    image = Image.new("RGB", LAYOUT_SIZE, "white")
+    draw = ImageDraw.Draw(image)
+    cover = decode_data_uri(context["cover"])
+    if cover is not None:
+        image.paste(cover.convert("RGB").resize((480, 480)), (0, 0))
+    for uri, x in [
+        (context["spotify_qrcode"], 490),
+        (context["discogs_qrcode"], 645),
+    ]:
+        qrcode = decode_data_uri(uri)
+        if qrcode is not None:
+            image.paste(qrcode.convert("RGB").resize((145, 145)), (x, 10))
+    title = context["title"] + (f" ({context['year']})" if context["year"] else "")
+    y = wrap(draw, [(title, font(16))], (505, 180), 270, 19)
+    y = wrap(draw, [(context["artist"], font(16, BOLD_FONTS))], (505, y), 270, 19)
+    credits = []
+    for credit in context["credits"] or []:
+        credits.append((credit["name"], font(13, BOLD_FONTS)))
+        credits.append((f" ({credit['role']});", font(13)))
+    wrap(draw, credits, (505, y + 19), 270, 16)
+    return image
+
+
+def centred(draw, y: int, text: str, text_font) -> int:
+    """Draw text centred across the card, returning the y below it."""
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=text_font)
+    draw.text(((LAYOUT_SIZE[0] - right) / 2, y), text, font=text_font, fill="black")
+    return y + bottom
+
+
+def draw_weather(data: dict, icon: Optional[Image.Image] = None) -> Image.Image:
+    """Draw the weather from the values of the weather template."""
+    image = Image.new("RGB", LAYOUT_SIZE, "white")
+    draw = ImageDraw.Draw(image)
+    draw.text((17, 17), data["location"], font=font(16, SANS_FONTS), fill="black")
+    y = centred(draw, 100, data["temp"], font(45, SANS_FONTS))
+    centred(draw, y + 8, data["description"], font(14, SANS_FONTS))
+    # As in the template, humidity and sunshine are placeholders.
+    for i, line in enumerate([data["wind"], "84%", "0.2h"]):
+        draw.text((45, 240 + 36 * i), line, font=font(24, SANS_FONTS), fill="black")
+    if icon is not None:
+        icon = icon.convert("RGBA").resize((200, 200))
+        image.paste(icon, (583, 190), icon)
+    chart = decode_data_uri(data["precipitation"])
+    if chart is not None:
+        image.paste(chart.convert("RGB"), (17, LAYOUT_SIZE[1] - 17 - CHART_SIZE[1]))
+    return image
+
+
+def draw_precipitation(amounts) -> Image.Image:
+    """A bar chart of precipitation amounts, drawn in the colours of
+    PALETTE so that it needs no dithering."""
+    width, height = CHART_SIZE
+    image = Image.new("P", CHART_SIZE, WHITE)
+    image.putpalette(PALETTE.flatten().tolist())
+    draw = ImageDraw.Draw(image)
+    scale = (height - 1) / max(max(amounts), CHART_MIN_SCALE)
+    bar = width / len(amounts)
+    for i, amount in enumerate(amounts):
+        top = height - 1 - round(amount * scale)
+        if top < height - 1:
+            draw.rectangle(
+                [round(i * bar) + 2, top, round((i + 1) * bar) - 3, height - 1],
+                fill=BLUE,
+            )
+    draw.line([(0, height - 1), (width, height - 1)], fill=BLACK)
+    return image
@@ -1,4 +1,4 @@
-from framey import make_discogs_cards, make_spotify_cards
+from framey.cards import make_discogs_cards, make_spotify_cards
 
 make_spotify_cards()
 make_discogs_cards()
@@ -4,9 +4,10 @@ import shutil
 
 from PIL import Image
 
-from framey import Album, make_html, render_image
+from framey import render_html
+from framey.spotify import Album, make_html
 
-html_dir = make_html(
+html = make_html(
     Album(
         cover=Image.open(
             importlib.resources.files("framey").joinpath("sample-cover.jpeg")
@@ -16,10 +17,13 @@ html_dir = make_html(
         year="2016",
         spotify_url="https://spotify.com",
         discogs_url="https://discogs.com",
+        credits=None,
     )
 )
 
-render_image(html_dir).save("sample.png")
+render_html(html).save("sample.png")
 if os.path.isdir("sample"):
     shutil.rmtree("sample")
-shutil.copytree(html_dir.name, "sample")
+os.mkdir("sample")
+with open(os.path.join("sample", "index.html"), "w") as f:
+    f.write(html)
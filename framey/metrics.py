@@ -0,0 +1,124 @@
+"""Timings of each stage of rendering, counts of upstream calls, cache
+hits and errors, exported in the Prometheus text format. Recording is
+a dictionary update, cheap enough to leave on. Each process keeps its
+own metrics."""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# Counter values by metric name and sorted label items.
+COUNTERS = defaultdict(float)
+# Caches reporting their own hits and misses, e.g. LRUCache, by name.
+CACHES = {}
+HELP = {
+    "framey_stage_seconds": "Time spent in each stage of rendering.",
+    "framey_stage_errors_total": "Stages which raised an exception.",
+    "framey_upstream_calls_total": "Requests made to upstream services.",
+    "framey_cache_requests_total": "Cache lookups, by whether they hit.",
+}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def count(name: str, amount: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        COUNTERS[key] += amount
+
+
+def upstream(service: str):
+    count("framey_upstream_calls_total", service=service)
+
+
+def cache_lookup(cache: str, hit: bool):
+    count("framey_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a stage, counting it as an error if it raises. The time is
+    also kept for the Server-Timing of whatever this thread is
+    recording."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count("framey_stage_errors_total", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        timings = getattr(_local, "timings", None)
+        with _lock:
+            COUNTERS[("framey_stage_seconds_sum", (("stage", stage),))] += elapsed
+            COUNTERS[("framey_stage_seconds_count", (("stage", stage),))] += 1
+            # Under the lock, as threads may share timings, see recorded.
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0) + elapsed
+
+
+@contextmanager
+def recording(timings: Optional[Dict[str, float]] = None):
+    """Collect the stages timed by this thread into timings, or a new
+    dict, yielding the dict of their seconds by name."""
+    previous = getattr(_local, "timings", None)
+    _local.timings = timings = {} if timings is None else timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def recorded(function: Callable) -> Callable:
+    """Wrap function to record its stages into what this thread is
+    recording, for running it on another thread."""
+    timings = getattr(_local, "timings", None)
+
+    def run(*args, **kwargs):
+        with recording(timings):
+            return function(*args, **kwargs)
+
+    return run
+
+
+def server_timing(timings: Optional[Dict[str, float]]) -> str:
+    """A Server-Timing header value, in milliseconds."""
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}"
+        for stage, seconds in (timings or {}).items()
+    )
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def exposition() -> str:
+    """All metrics in the Prometheus text format."""
+    for name, cache in CACHES.items():
+        with _lock:
+            for result, value in (("hit", cache.hits), ("miss", cache.misses)):
+                key = (
+                    "framey_cache_requests_total",
+                    (("cache", name), ("result", result)),
+                )
+                COUNTERS[key] = value
+    with _lock:
+        counters = sorted(COUNTERS.items())
+    lines = []
+    for metric, kind in [
+        ("framey_stage_seconds", "summary"),
+        ("framey_stage_errors_total", "counter"),
+        ("framey_upstream_calls_total", "counter"),
+        ("framey_cache_requests_total", "counter"),
+    ]:
+        lines.append(f"# HELP {metric} {HELP[metric]}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for (name, labels), value in counters:
+            if name == metric or name.startswith(metric + "_"):
+                lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,276 @@
+"""Render module images in the background, so that requests are
+served from memory."""
+
+import fcntl
+import logging
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, Optional, Tuple, Union
+from urllib.parse import quote
+
+from framey import PROFILES, Profile, TileDitherer, encode_image, metrics
+from framey.cache import CACHE_DIR, SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# Where jobs lock while refreshing, so that all the server processes
+# on a machine share one refresh.
+SHARED_DIR = os.path.join(CACHE_DIR, "rendered")
+
+
+@dataclass
+class Rendered:
+    etag: str
+    # Encoded images by profile and format, None if the module had
+    # nothing to show.
+    bodies: Optional[Dict[str, Dict[str, bytes]]]
+    # time.time() of the last check of the module's state.
+    checked: float
+    # Settings each profile's JPEG was fit to its budget with.
+    jpeg: Optional[Dict[str, Optional[dict]]] = None
+    # Seconds taken by each stage of the last check and render.
+    timings: Optional[Dict[str, float]] = None
+    # The profiles the bodies were rendered for. These may have been
+    # set differently when the image was stored, see Job.current.
+    profiles: Optional[Dict[str, Profile]] = None
+
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on path, shared between processes."""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RenderedStore(SQLiteStore):
+    """The latest image of each job, shared by the server processes
+    so that any of them can serve an image another rendered. Beyond
+    max_bytes the least recently checked images are evicted."""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS renders"
+        " (name TEXT PRIMARY KEY, rendered BLOB, checked REAL, size INTEGER)"
+    )
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+
+    def get(self, name: str) -> Optional[Rendered]:
+        row = (
+            self._db()
+            .execute("SELECT rendered, checked FROM renders WHERE name = ?", (name,))
+            .fetchone()
+        )
+        # checked is updated apart from the rest, see touch.
+        return None if row is None else replace(pickle.loads(row[0]), checked=row[1])
+
+    def touch(self, name: str, checked: float) -> bool:
+        """Record a check which found the image unchanged, without
+        writing it again. Returns False if the image is not stored."""
+        db = self._db()
+        with db:
+            cursor = db.execute(
+                "UPDATE renders SET checked = ? WHERE name = ?", (checked, name)
+            )
+        return cursor.rowcount > 0
+
+    def put(self, name: str, rendered: Rendered):
+        db = self._db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?)",
+                (
+                    name,
+                    pickle.dumps(rendered),
+                    rendered.checked,
+                    sum(
+                        len(body)
+                        for bodies in (rendered.bodies or {}).values()
+                        for body in bodies.values()
+                    ),
+                ),
+            )
+            total = 0
+            for other, size in db.execute(
+                "SELECT name, size FROM renders ORDER BY checked DESC"
+            ).fetchall():
+                total += size
+                if total > self.max_bytes and other != name:
+                    db.execute("DELETE FROM renders WHERE name = ?", (other,))
+
+
+RENDERED = RenderedStore(os.path.join(SHARED_DIR, "rendered.sqlite"))
+
+
+class Job:
+    """Keeps the encoded images of one module up to date. state
+    returns an ETag and a function to render the image for a Profile,
+    which is only called, for each of PROFILES, when the ETag changes.
+    interval is the seconds between checks, or a function returning
+    it."""
+
+    def __init__(
+        self,
+        name: str,
+        state: Callable[[], Tuple[str, Callable]],
+        interval: Union[float, Callable[[], float]],
+    ):
+        self.name = name
+        self.state = state
+        self.interval = interval
+        self.rendered: Optional[Rendered] = None
+        # Each profile's last image is kept to dither only what changed.
+        self._ditherers: Dict[str, TileDitherer] = {}
+        self._refreshing = threading.Lock()
+
+    def refresh(self, wait: bool = False):
+        """Check the state and render if it changed. If a refresh is
+        already running, returns at once or, if wait, once it is done.
+        Only one process refreshes at a time, the rest take up what it
+        put in RENDERED."""
+        started = time.time()
+        if not self._refreshing.acquire(blocking=wait):
+            return
+        try:
+            if self.rendered is not None and self.rendered.checked >= started:
+                return
+            os.makedirs(SHARED_DIR, exist_ok=True)
+            with file_lock(
+                os.path.join(SHARED_DIR, quote(self.name, safe="") + ".lock")
+            ):
+                published = RENDERED.get(self.name)
+                if self.current(published) and not self.stale(published):
+                    self.rendered = published
+                    return
+                with metrics.recording() as timings:
+                    with metrics.timed("state"):
+                        etag, render = self.state()
+                    now = time.time()
+                    if self.current(self.rendered, etag):
+                        self.rendered = replace(self.rendered, checked=now)
+                    elif self.current(published, etag):
+                        self.rendered = replace(published, checked=now)
+                    else:
+                        self.rendered = self._render(
+                            etag, render, now, published, timings
+                        )
+                # Images are large and most checks find them unchanged,
+                # so then only the time of the check is written.
+                if not self.current(published, etag) or not RENDERED.touch(
+                    self.name, now
+                ):
+                    RENDERED.put(self.name, self.rendered)
+        finally:
+            self._refreshing.release()
+
+    def _render(self, etag, render, now, published, timings) -> Rendered:
+        # The last JPEG settings are a good guess at the next.
+        last = self.rendered or published
+        hints = (last.jpeg if last is not None else None) or {}
+        bodies, jpeg = {}, {}
+        for key, profile in PROFILES.items():
+            bodies[key], jpeg[key] = encode_image(
+                render(profile),
+                profile.jpeg_budget,
+                hints.get(key),
+                self._ditherers.setdefault(key, TileDitherer()),
+            )
+        if None in bodies.values():
+            return Rendered(etag, None, now, None, timings, PROFILES)
+        return Rendered(etag, bodies, now, jpeg, timings, PROFILES)
+
+    def wait(self) -> float:
+        return self.interval() if callable(self.interval) else self.interval
+
+    @staticmethod
+    def current(rendered: Optional[Rendered], etag: Optional[str] = None) -> bool:
+        """Whether rendered is for PROFILES, and for etag if given. An
+        image stored before a restart with other profiles or budgets
+        is rendered again."""
+        return (
+            rendered is not None
+            and rendered.profiles == PROFILES
+            and (etag is None or rendered.etag == etag)
+        )
+
+    def stale(self, rendered: Optional[Rendered] = None) -> bool:
+        rendered = rendered or self.rendered
+        return rendered is None or time.time() - rendered.checked > self.wait()
+
+    def latest(self) -> Optional[Rendered]:
+        """Return the latest image without rendering. A missing or
+        stale image is first looked for in RENDERED, in case another
+        process has rendered it."""
+        if self.rendered is None or self.stale():
+            shared = RENDERED.get(self.name)
+            if self.current(shared) and (
+                self.rendered is None or shared.checked > self.rendered.checked
+            ):
+                self.rendered = shared
+        return self.rendered
+
+    def get(self) -> Optional[Rendered]:
+        """Return the latest image. Only waits if nothing has been
+        rendered yet, sharing the first render between concurrent
+        callers; a stale image is returned while a refresh runs in the
+        background."""
+        rendered = self.latest()
+        if rendered is None:
+            self.refresh(wait=True)
+            return self.rendered
+        if self.stale(rendered):
+            threading.Thread(target=self._refresh_logged, daemon=True).start()
+        return rendered
+
+    def _refresh_logged(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Refreshing %s failed", self.name)
+
+    def run(self):
+        while True:
+            self._refresh_logged()
+            time.sleep(self.wait())
+
+
+class Scheduler:
+    """Runs a Job per module in a background thread. Threads are
+    started on first use in each process, so that every gunicorn
+    worker gets its own."""
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, state: Callable, interval):
+        self.jobs[name] = Job(name, state, interval)
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for name, job in self.jobs.items():
+                threading.Thread(target=job.run, name=name, daemon=True).start()
+
+    def get(self, name: str) -> Optional[Rendered]:
+        if self._pid != os.getpid():
+            self.start()
+        return self.jobs[name].get()
+
+    def latest(self, name: str) -> Optional[Rendered]:
+        if self._pid != os.getpid():
+            self.start()
+        return self.jobs[name].latest()
@@ -1,40 +1,167 @@
-import tempfile
-from zlib import adler32
+import importlib
+import os
+import threading
 
-import spotipy
-from flask import Flask, make_response, request, send_file
-from spotipy.oauth2 import SpotifyOAuth
-from werkzeug.utils import send_file
+from flask import Flask, abort, jsonify, make_response, request
 
-from framey import dither_image
-from framey.spotify import make_now_playing_image
-from framey.weather import make_weather_image
+import framey
+from framey import FORMATS, PROFILES, metrics, spotify
+from framey.browser import chrome_available
+from framey.scheduler import Scheduler
+from framey.spotify import NowPlayingPoller
+from framey.weather import LOCATIONS, weather_state
 
-SCOPE = "user-library-read,user-read-currently-playing,user-read-recently-played"
+# How often, in seconds, to check each module for changes. Spotify
+# is checked less often, up to PLAYING_IDLE_INTERVAL, when nothing is
+# playing.
+PLAYING_INTERVAL = float(os.getenv("PLAYING_INTERVAL", 15))
+PLAYING_IDLE_INTERVAL = float(os.getenv("PLAYING_IDLE_INTERVAL", 120))
+WEATHER_INTERVAL = float(os.getenv("WEATHER_INTERVAL", 15 * 60))
+# How to render each module, "chrome" or "pillow", which draws the
+# cards without a browser. Chrome is used if it is installed.
+DEFAULT_RENDERER = "chrome" if chrome_available() else "pillow"
+PLAYING_RENDERER = os.getenv("PLAYING_RENDERER", DEFAULT_RENDERER)
+WEATHER_RENDERER = os.getenv("WEATHER_RENDERER", DEFAULT_RENDERER)
 
 app = Flask(__name__)
 
-# Force login if not cached.
-spotify_client = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=SCOPE)).current_user()
+SCHEDULER = Scheduler()
+POLLER = NowPlayingPoller(PLAYING_INTERVAL, PLAYING_IDLE_INTERVAL, PLAYING_RENDERER)
+SCHEDULER.add("playing", POLLER.state, interval=lambda: POLLER.interval)
+for key, location in LOCATIONS.items():
+    SCHEDULER.add(
+        f"weather/{key}",
+        lambda location=location: weather_state(location, WEATHER_RENDERER),
+        interval=WEATHER_INTERVAL,
+    )
 
 
-def serve_image(image):
-    tmpfile = tempfile.NamedTemporaryFile(suffix=".jpeg")
-    image = image.convert("RGB")
-    image = dither_image(image)
-    image.save(tmpfile, format="JPEG")
-    tmpfile.seek(0)
-    etag = str(adler32(tmpfile.read()) & 0xFFFFFFFF)
-    tmpfile.seek(0)
-    return send_file(tmpfile, request.environ, mimetype="image/jpeg", etag=etag)
+# The status of each step of warm_up in this process: "pending", "ok"
+# or the error it failed with.
+WARM_UP = {}
+_warm_up_lock = threading.Lock()
+_warm_up_pid = None
 
 
-@app.route("/playing.jpeg")
-def now_playing():
-    spotify_client = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=SCOPE))
-    return serve_image(make_now_playing_image(spotify_client))
+def warm_up_steps():
+    """What the first renders would otherwise load or start: modules
+    and clients, which are only loaded when used so that workers
+    start quickly, a browser and the background jobs."""
+    steps = {
+        "qrcode": lambda: importlib.import_module("qrcode.image.styledpil"),
+        "logos": lambda: [spotify.logo("spotify.png"), spotify.logo("discogs.png")],
+        "discogs": spotify.discogs,
+        "spotify": spotify.spotify_client,
+    }
+    if "chrome" in (PLAYING_RENDERER, WEATHER_RENDERER):
+        steps["browser"] = framey.BROWSER_POOL.warm_up
+    steps["scheduler"] = SCHEDULER.start
+    return steps
 
 
-@app.route("/weather.jpeg")
-def weather():
-    return serve_image(make_weather_image())
+def warm_up_failed() -> bool:
+    return any(status not in ("ok", "pending") for status in WARM_UP.values())
+
+
+def warm_up():
+    """Run each of warm_up_steps, once per process, recording their
+    status in WARM_UP; called again, only the steps which failed are
+    run. Call it from a gunicorn post_worker_init hook, or let /ready
+    start it."""
+    global _warm_up_pid
+    with _warm_up_lock:
+        if _warm_up_pid != os.getpid():
+            _warm_up_pid = os.getpid()
+            WARM_UP.clear()
+        steps = {
+            name: step
+            for name, step in warm_up_steps().items()
+            if WARM_UP.get(name) not in ("ok", "pending")
+        }
+        WARM_UP.update((name, "pending") for name in steps)
+    for name, step in steps.items():
+        try:
+            step()
+            WARM_UP[name] = "ok"
+        except Exception as e:
+            WARM_UP[name] = repr(e)
+
+
+def serve_rendered(name, format):
+    """Serve the latest pre-rendered image of a module in one of
+    FORMATS, for the display profile requested."""
+    profile = request.args.get("profile", next(iter(PROFILES)))
+    if name not in SCHEDULER.jobs or profile not in PROFILES:
+        abort(404)
+    rendered = SCHEDULER.get(name)
+    if rendered is None or rendered.bodies is None:
+        abort(404)
+    response = make_response(rendered.bodies[profile][format])
+    response.mimetype = FORMATS[format][0]
+    response.set_etag(rendered.etag)
+    if rendered.timings:
+        # How long the image took to render, not this response.
+        response.headers["Server-Timing"] = metrics.server_timing(rendered.timings)
+    return response.make_conditional(request)
+
+
+@app.route("/playing.<any(jpeg, png, raw):format>")
+def now_playing(format):
+    return serve_rendered("playing", format)
+
+
+@app.route("/weather.<any(jpeg, png, raw):format>")
+def weather(format):
+    location = request.args.get("location", next(iter(LOCATIONS)))
+    return serve_rendered(f"weather/{location}", format)
+
+
+@app.route("/encoder")
+def encoder():
+    """The size of each module's latest images in each format, and the
+    settings their JPEGs were fit to the budget with, by profile."""
+    report = {}
+    for name, job in SCHEDULER.jobs.items():
+        rendered = job.rendered
+        if rendered is not None and rendered.bodies is not None:
+            report[name] = {
+                profile: {
+                    "bytes": {format: len(body) for format, body in bodies.items()},
+                    "jpeg": rendered.jpeg[profile],
+                }
+                for profile, bodies in rendered.bodies.items()
+            }
+    return jsonify(report)
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Stage timings, upstream calls and cache hits of this process."""
+    response = make_response(metrics.exposition())
+    response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+@app.route("/ready")
+def ready():
+    """Whether this process has warmed up, starting it, or retrying
+    the steps which failed, if need be."""
+    if _warm_up_pid != os.getpid() or warm_up_failed():
+        threading.Thread(target=warm_up, daemon=True).start()
+        ready = False
+    else:
+        ready = all(status == "ok" for status in WARM_UP.values())
+    response = jsonify({"ready": ready, "warm_up": dict(WARM_UP)})
+    response.status_code = 200 if ready else 503
+    return response
+
+
+@app.route("/version")
+def version():
+    """The ETag of each module's latest image, to check for changes
+    without downloading it. Modules not rendered yet are null."""
+    versions = {}
+    for name in SCHEDULER.jobs:
+        rendered = SCHEDULER.latest(name)
+        versions[name] = rendered.etag if rendered else None
+    return jsonify(versions)
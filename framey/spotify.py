@@ -1,31 +1,109 @@
+import functools
 import importlib.resources
+import io
+import logging
 import os
-import tempfile
-from dataclasses import dataclass
-from typing import List, Optional, Union
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from typing import Callable, List, Optional, Tuple, Union
 
 import chevron
-import discogs_client
-import requests
 from PIL import Image
 
 from framey import (
-    HEADERS,
+    SESSION,
+    TIMEOUT,
     USER_AGENT,
-    dither_image_path,
-    render_image,
+    data_uri,
+    dither_image,
+    encode_png,
+    html_renderer,
+    image_data_uri,
+    image_renderer,
     make_qrcode,
+    metrics,
+    state_etag,
 )
+from framey import draw
+from framey.cache import CACHE_DIR, MISSING, Cache, FileStore
 
 HTML_TEMPLATE = importlib.resources.read_text(
     "framey", "spotify_now_playing.html.moustache", encoding="utf-8"
 )
-with importlib.resources.path("framey", "spotify.png") as file:
-    SPOTIFY_PNG = Image.open(file)
-with importlib.resources.path("framey", "discogs.png") as file:
-    DISCOGS_PNG = Image.open(file)
+# Logos are shrunk, as QR codes only embed them small.
+LOGO_SIZE = (256, 256)
 
-DISCOGS_CLIENT = discogs_client.Client(USER_AGENT, user_token=os.getenv("TOKEN"))
+logger = logging.getLogger(__name__)
+
+SCOPE = "user-library-read,user-read-currently-playing,user-read-recently-played"
+# Functions called with the method and url of every Spotify API
+# request, e.g. to count them.
+CALL_HOOKS = []
+
+# Created on first use by discogs(); a stand in may be set instead.
+DISCOGS_CLIENT = None
+DISCOGS_CACHE = Cache(os.path.join(CACHE_DIR, "discogs.sqlite"))
+# Seconds to cache Discogs results, and how long to remember albums
+# Discogs does not have, since they may be added.
+DISCOGS_TTL = 30 * 24 * 60 * 60
+DISCOGS_MISS_TTL = 24 * 60 * 60
+# Downloaded covers, and the dithered versions of them.
+COVER_STORE = FileStore(os.path.join(CACHE_DIR, "covers"))
+# Set when Spotify rate limits a process, until it may be called
+# again, to the album then playing, so that the other server
+# processes wait too.
+RATE_LIMITS = Cache(os.path.join(CACHE_DIR, "spotify.sqlite"))
+# Runs the independent stages of building the html at the same time.
+EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="framey")
+# Discogs lookups get their own threads, as one which is given up on
+# keeps running and would otherwise hold up the other stages.
+DISCOGS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="framey-discogs"
+)
+# Seconds to wait for each stage; without Discogs we can still render.
+DISCOGS_TIMEOUT = 10
+STAGE_TIMEOUT = 30
+
+
+_spotify_client = None
+_clients_lock = threading.Lock()
+
+
+def spotify_client():
+    """The Spotify client shared by the process, created on first
+    use. spotipy refreshes its token a minute before it expires."""
+    global _spotify_client
+    with _clients_lock:
+        if _spotify_client is None:
+            from framey.spotify_api import make_spotify_client
+
+            _spotify_client = make_spotify_client()
+        return _spotify_client
+
+
+def discogs():
+    """The Discogs client, created on first use."""
+    global DISCOGS_CLIENT
+    with _clients_lock:
+        if DISCOGS_CLIENT is None:
+            import discogs_client
+
+            DISCOGS_CLIENT = discogs_client.Client(
+                USER_AGENT, user_token=os.getenv("TOKEN")
+            )
+            DISCOGS_CLIENT.set_timeout(connect=TIMEOUT, read=TIMEOUT)
+        return DISCOGS_CLIENT
+
+
+@functools.lru_cache(maxsize=None)
+def logo(name: str) -> Image.Image:
+    """A logo to embed in QR codes, loaded on first use."""
+    with importlib.resources.path("framey", name) as file:
+        image = Image.open(file)
+        image.thumbnail(LOGO_SIZE)
+    return image
 
 
 @dataclass
@@ -36,7 +114,7 @@ class Album:
     spotify_url: Optional[str]
     discogs_url: Optional[str]
     cover: Union[str, Image.Image]
-    credits: Optional[str]
+    credits: Optional[List[dict]]
 
 
 def make_spotify_album(item) -> Album:
@@ -51,73 +129,230 @@ def make_spotify_album(item) -> Album:
     )
 
 
-def discogs_enhance(album):
-    results = DISCOGS_CLIENT.search(f"{album.title} {album.artist}", type="master")
-    if len(results) > 0:
-        credits = results[0].main_release.credits
-        url = results[0].url
-    else:
-        results = DISCOGS_CLIENT.search(f"{album.title} {album.artist}", type="release")
+def discogs_lookup(title: str, artist: str) -> Optional[Tuple[List[dict], str]]:
+    """Search Discogs for an album, returning its credits and url."""
+    with metrics.timed("discogs"):
+        metrics.upstream("discogs")
+        results = discogs().search(f"{title} {artist}", type="master")
         if len(results) > 0:
-            credits = results[0].credits
+            credits = results[0].main_release.credits
             url = results[0].url
         else:
-            return
-    album.credits = credits
-    album.discogs_url = url
+            metrics.upstream("discogs")
+            results = discogs().search(f"{title} {artist}", type="release")
+            if len(results) > 0:
+                credits = results[0].credits
+                url = results[0].url
+            else:
+                return None
+        return [{"name": credit.name, "role": credit.role} for credit in credits], url
+
+
+def discogs_key(album: Album) -> str:
+    return " ".join(f"{album.title}\0{album.artist}".casefold().split())
+
 
+def discogs_details(album) -> Optional[Tuple[List[dict], str]]:
+    """Credits and url of an album from Discogs, via the cache."""
+    key = discogs_key(album)
+    found = DISCOGS_CACHE.get(key)
+    metrics.cache_lookup("discogs", found is not MISSING)
+    if found is MISSING:
+        found = discogs_lookup(album.title, album.artist)
+        DISCOGS_CACHE.set(key, found, DISCOGS_TTL if found else DISCOGS_MISS_TTL)
+    return found
 
-def make_now_playing_image(spotify_client):
+
+def discogs_enhance(album):
+    found = discogs_details(album)
+    if found is not None:
+        album.credits, album.discogs_url = found
+
+
+def current_track(spotify_client) -> Tuple[Optional[dict], bool]:
+    """The track playing, or else the last played, and whether it is
+    playing."""
     current_playing = spotify_client.current_user_playing_track()
     if current_playing is not None:
-        last_track = current_playing["item"]
-    else:
-        last_track = spotify_client.current_user_recently_played(limit=1)["items"][0][
-            "track"
-        ]
+        return current_playing["item"], current_playing["is_playing"]
+    last_track = spotify_client.current_user_recently_played(limit=1)["items"][0][
+        "track"
+    ]
+    return last_track, False
+
+
+def now_playing_album(spotify_client) -> Optional[Album]:
+    last_track, _ = current_track(spotify_client)
     if last_track is not None:
-        album = make_spotify_album(last_track["album"])
-        discogs_enhance(album)
-        return render_image(make_html(album))
+        return make_spotify_album(last_track["album"])
+
+
+def album_html(album: Album) -> str:
+    with metrics.timed("html"):
+        return make_html(album, enhance=True)
+
+
+def draw_album(album: Album) -> Image.Image:
+    with metrics.timed("html"):
+        context = album_context(album, enhance=True)
+    return draw.draw_album(context)
+
+
+def album_state(
+    album: Optional[Album], renderer: str = "chrome"
+) -> Tuple[str, Callable]:
+    """Return an ETag for the image of an album and a function to
+    render it, with Chrome or Pillow. Only Spotify is called until the
+    image is rendered, since the Discogs details follow from the
+    Spotify album."""
+    if album is None:
+        return state_etag(None), html_renderer(lambda: None)
+    etag = state_etag(renderer, HTML_TEMPLATE, asdict(album))
+    if renderer == "pillow":
+        return etag, image_renderer(lambda: draw_album(album))
+    return etag, html_renderer(lambda: album_html(album))
+
+
+class RateLimited(Exception):
+    pass
+
+
+class NowPlayingPoller:
+    """Polls Spotify for the now playing album, adapting interval:
+    every playing_interval seconds while music plays, backing off to
+    idle_interval when it does not, and waiting as long as Spotify
+    asks when rate limited. Until then the last album is returned
+    without calling Spotify, by every process sharing RATE_LIMITS.
+    Albums are rendered with renderer, see album_state."""
+
+    def __init__(
+        self,
+        playing_interval: float = 15,
+        idle_interval: float = 120,
+        renderer: str = "chrome",
+    ):
+        self.playing_interval = playing_interval
+        self.idle_interval = idle_interval
+        self.renderer = renderer
+        self.interval = playing_interval
+        self.album = None
+        # time.time() before which Spotify asked not to be called.
+        self.not_before = 0.0
 
+    def state(self) -> Tuple[str, Callable]:
+        from spotipy import SpotifyException
 
-def download_cover(tmpdir, album) -> str:
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False, dir=tmpdir) as out:
-        if isinstance(album.cover, str):
-            resp = requests.get(album.cover, headers=HEADERS, stream=True)
-            resp.raise_for_status()
-            out.write(resp.content)
+        if self.rate_limited():
+            if self.album is None:
+                raise RateLimited("Spotify asked to wait before calling again")
+            return album_state(self.album, self.renderer)
+        try:
+            last_track, playing = current_track(spotify_client())
+        except SpotifyException as e:
+            if e.http_status == 429:
+                retry_after = (e.headers or {}).get("Retry-After")
+                self.interval = float(retry_after or self.idle_interval)
+                self.not_before = time.time() + self.interval
+                RATE_LIMITS.set(
+                    "now_playing",
+                    None if self.album is None else asdict(self.album),
+                    self.interval,
+                )
+            raise
+        if playing:
+            self.interval = self.playing_interval
         else:
-            album.cover.save(out)
-        dither_image_path(out.name)
-        return os.path.basename(out.name)
-
-
-def make_html(album: Album) -> tempfile.TemporaryDirectory():
-    tmpdir = tempfile.TemporaryDirectory()
-    with open(os.path.join(tmpdir.name, "index.html"), "w") as f:
-        f.write(
-            chevron.render(
-                HTML_TEMPLATE,
-                {
-                    "cover": download_cover(tmpdir.name, album),
-                    "year": album.year,
-                    "title": album.title,
-                    "artist": album.artist,
-                    "credits": album.credits,
-                    "spotify_qrcode": make_qrcode(
-                        album.spotify_url,
-                        embed_image=SPOTIFY_PNG,
-                        color=(0, 255, 0),
-                        tmpdir=tmpdir.name,
-                    ),
-                    "discogs_qrcode": make_qrcode(
-                        album.discogs_url,
-                        embed_image=DISCOGS_PNG,
-                        color=(0, 0, 0),
-                        tmpdir=tmpdir.name,
-                    ),
-                },
-            )
-        )
-    return tmpdir
+            self.interval = min(self.interval * 2, self.idle_interval)
+        album = None
+        if last_track is not None:
+            album = make_spotify_album(last_track["album"])
+        if (
+            album is None
+            or self.album is None
+            or album.spotify_url != self.album.spotify_url
+        ):
+            self.album = album
+        return album_state(self.album, self.renderer)
+
+    def rate_limited(self) -> bool:
+        """Whether Spotify asked this or another process to wait,
+        taking up the album the other process had then."""
+        if time.time() < self.not_before:
+            return True
+        limited = RATE_LIMITS.get("now_playing")
+        if limited is MISSING:
+            return False
+        if limited is not None:
+            self.album = Album(**limited)
+        return True
+
+
+def download_cover(album) -> str:
+    """Fetch and dither the album cover, returning it as a data URI.
+    Both the download and the dithered cover are kept in the
+    COVER_STORE."""
+    if not isinstance(album.cover, str):
+        return image_data_uri(dither_image(album.cover))
+    dithered = COVER_STORE.get(album.cover + "#dithered")
+    metrics.cache_lookup("cover", dithered is not None)
+    if dithered is None:
+        original = COVER_STORE.get(album.cover)
+        if original is None:
+            metrics.upstream("cover")
+            with metrics.timed("cover_download"):
+                resp = SESSION.get(album.cover, timeout=TIMEOUT)
+                resp.raise_for_status()
+            original = resp.content
+            COVER_STORE.set(album.cover, original)
+        with metrics.timed("cover_dither"):
+            dithered = encode_png(dither_image(Image.open(io.BytesIO(original))))
+        COVER_STORE.set(album.cover + "#dithered", dithered)
+    return data_uri(dithered)
+
+
+def make_html(album: Album, enhance: bool = False) -> str:
+    """Build the html for an album, see album_context."""
+    return chevron.render(HTML_TEMPLATE, album_context(album, enhance))
+
+
+def album_context(album: Album, enhance: bool = False) -> dict:
+    """Build the values of the template for an album, first adding
+    its Discogs details if enhance. The cover, QR codes and Discogs
+    lookup are fetched concurrently; if Discogs fails the album is
+    shown without them. album itself is left as it is, as its state
+    is what decides whether to render it again."""
+    album = replace(album)
+    if enhance:
+        discogs = DISCOGS_EXECUTOR.submit(metrics.recorded(discogs_details), album)
+    cover = EXECUTOR.submit(metrics.recorded(download_cover), album)
+    spotify_qrcode = EXECUTOR.submit(
+        metrics.recorded(make_qrcode),
+        album.spotify_url,
+        embed_image=logo("spotify.png"),
+        color=(0, 255, 0),
+    )
+    if enhance:
+        try:
+            found = discogs.result(timeout=DISCOGS_TIMEOUT)
+            if found is not None:
+                album.credits, album.discogs_url = found
+        except Exception:
+            logger.warning("Discogs lookup of %s failed", album.title, exc_info=True)
+    return {
+        "cover": cover.result(timeout=STAGE_TIMEOUT),
+        "year": album.year,
+        "title": album.title,
+        "artist": album.artist,
+        "credits": album.credits,
+        "spotify_qrcode": spotify_qrcode.result(timeout=STAGE_TIMEOUT),
+        "discogs_qrcode": make_qrcode(
+            album.discogs_url,
+            embed_image=logo("discogs.png"),
+            color=(0, 0, 0),
+        ),
+    }
+
+
+if __name__ == "__main__":
+    # Log in to Spotify, caching the token for the server.
+    print(spotify_client().current_user()["display_name"])
@@ -0,0 +1,49 @@
+"""The Spotify API client, apart from framey.spotify so that spotipy
+is only imported once Spotify is called."""
+
+import spotipy
+from spotipy.cache_handler import CacheFileHandler, CacheHandler
+from spotipy.oauth2 import SpotifyOAuth
+
+from framey import SESSION, TIMEOUT, metrics, spotify
+from framey.cache import MISSING
+
+
+class MemoryTokenCache(CacheHandler):
+    """Keeps the Spotify token in memory, reading the cache file only
+    once and writing it only when the token is refreshed."""
+
+    def __init__(self, handler: CacheHandler = None):
+        self.handler = handler or CacheFileHandler()
+        self.token_info = MISSING
+
+    def get_cached_token(self):
+        if self.token_info is MISSING:
+            self.token_info = self.handler.get_cached_token()
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+        self.handler.save_token_to_cache(token_info)
+
+
+class SpotifyClient(spotipy.Spotify):
+    def _internal_call(self, method, url, payload, params):
+        for hook in spotify.CALL_HOOKS:
+            hook(method, url)
+        metrics.upstream("spotify")
+        with metrics.timed("spotify"):
+            return super()._internal_call(method, url, payload, params)
+
+
+def make_spotify_client() -> SpotifyClient:
+    return SpotifyClient(
+        auth_manager=SpotifyOAuth(
+            scope=spotify.SCOPE,
+            cache_handler=MemoryTokenCache(),
+            requests_session=SESSION,
+            requests_timeout=TIMEOUT,
+        ),
+        requests_session=SESSION,
+        requests_timeout=TIMEOUT,
+    )
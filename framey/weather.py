@@ -1,18 +1,88 @@
 # From https://github.com/Dachaz/inky-weatherbox
 
-import requests
+import io
 import json
-import tempfile
 import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
 import chevron
-from framey import render_image
+import numpy as np
+import requests
+from PIL import Image
+
+from framey import (
+    SESSION,
+    TIMEOUT,
+    data_uri,
+    dither_image,
+    encode_indexed_png,
+    encode_png,
+    html_renderer,
+    image_renderer,
+    metrics,
+    render_html,
+    state_etag,
+)
+from framey import draw
+from framey.cache import CACHE_DIR, MISSING, FileStore, LRUCache
 import importlib
-import shutil
 
 HTML_TEMPLATE = importlib.resources.read_text(
     "framey", "weather.html.moustache", encoding="utf-8"
 )
 
+
+@dataclass(frozen=True)
+class Location:
+    name: str
+    latitude: float
+    longitude: float
+    temperature_unit: str = "celsius"
+    windspeed_unit: str = "kmh"
+
+
+# Locations served at /weather.jpeg?location=<key>, the first is the
+# default. Set WEATHER_LOCATIONS to JSON like {"berkeley": {"name":
+# "Berkeley, CA", "latitude": 37.87159, "longitude": -122.27275}} to
+# change them.
+if os.getenv("WEATHER_LOCATIONS"):
+    LOCATIONS = {
+        key: Location(**location)
+        for key, location in json.loads(os.getenv("WEATHER_LOCATIONS")).items()
+    }
+else:
+    LOCATIONS = {
+        "berkeley": Location(
+            name="Berkeley, CA",
+            latitude=37.87159,
+            longitude=-122.27275,
+            temperature_unit="fahrenheit",
+        )
+    }
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast?latitude=%s&longitude=%s&hourly=precipitation&daily=temperature_2m_max,temperature_2m_min,sunrise,sunset,windspeed_10m_max&current_weather=true&timezone=auto&temperature_unit=%s&windspeed_unit=%s"
+# open-meteo updates current weather every 15 minutes, so forecasts
+# are cached until the next quarter hour.
+FORECAST_INTERVAL = 15 * 60
+FORECASTS = {}
+FORECASTS_LOCK = threading.Lock()
+# Weather icons, dithered for the frame, as data URIs by url.
+ICONS = LRUCache(maxsize=32)
+metrics.CACHES["icon"] = ICONS
+# The dithered icons, so that each is only downloaded once.
+ICON_STORE = FileStore(os.path.join(CACHE_DIR, "icons"))
+# The size icons are shown at in the template.
+ICON_SIZE = (200, 200)
+# Hours of precipitation charted from the current hour, summed into
+# CHART_BARS bars.
+PRECIPITATION_HOURS = 24
+CHART_BARS = 12
+# Precipitation charts as data URIs, by a hash of the amounts.
+CHARTS = LRUCache(maxsize=16)
+metrics.CACHES["chart"] = CHARTS
+
 # https://gist.githubusercontent.com/stellasphere/9490c195ed2b53c707087c8c2db4ec0c/raw/7f2d37310ac5d5c309fd9d2f4dd98cc837c28237/descriptions.json
 CODES = {
     0: {
@@ -165,6 +235,46 @@ def get_human(data):
     return CODES[data["weathercode"]][when]
 
 
+def fetch_forecasts(locations: List[Location]) -> List[dict]:
+    """Fetch the forecasts of several locations, which must share
+    units, in one request."""
+    url = FORECAST_URL % (
+        ",".join(str(location.latitude) for location in locations),
+        ",".join(str(location.longitude) for location in locations),
+        locations[0].temperature_unit,
+        locations[0].windspeed_unit,
+    )
+    metrics.upstream("open-meteo")
+    with metrics.timed("forecast"):
+        response = SESSION.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        raw_data = response.json()
+    # A list is only returned for more than one location.
+    return raw_data if isinstance(raw_data, list) else [raw_data]
+
+
+def forecast(location: Location) -> dict:
+    """The forecast for a location from FORECASTS, refreshing it and
+    every configured location with the same units when it expires."""
+    with FORECASTS_LOCK:
+        now = time.time()
+        hit = location in FORECASTS and FORECASTS[location][1] > now
+        metrics.cache_lookup("forecast", hit)
+        if hit:
+            return FORECASTS[location][0]
+        locations = [location] + [
+            other
+            for other in LOCATIONS.values()
+            if other != location
+            and (other.temperature_unit, other.windspeed_unit)
+            == (location.temperature_unit, location.windspeed_unit)
+        ]
+        expires = (now // FORECAST_INTERVAL + 1) * FORECAST_INTERVAL
+        for other, raw_data in zip(locations, fetch_forecasts(locations)):
+            FORECASTS[other] = (raw_data, expires)
+        return FORECASTS[location][0]
+
+
 def fetch_data(
     latitude, longitude, location, temperature_unit="celsius", windspeed_unit="kmh"
 ):
@@ -179,12 +289,9 @@ def fetch_data(
         windspeed_unit = "kmh"
         wind_scale = 1
 
-    url = (
-        "https://api.open-meteo.com/v1/forecast?latitude=%s&longitude=%s&hourly=precipitation&daily=temperature_2m_max,temperature_2m_min,sunrise,sunset,windspeed_10m_max&current_weather=true&timezone=auto&temperature_unit=%s&windspeed_unit=%s"
-        % (latitude, longitude, temperature_unit, windspeed_unit)
+    raw_data = forecast(
+        Location(location, latitude, longitude, temperature_unit, windspeed_unit)
     )
-    response = requests.get(url)
-    raw_data = json.loads(response.text)
 
     TEMPUNIT = raw_data["daily_units"]["temperature_2m_max"]
     WINDUNIT = raw_data["daily_units"]["windspeed_10m_max"]
@@ -193,7 +300,7 @@ def fetch_data(
     data = {
         "baufort": to_baufort(windspeed * wind_scale),
         "icon": raw_data["current_weather"]["weathercode"],
-        "precipitation": raw_data["hourly"]["precipitation"],
+        "precipitation": precipitation_chart(precipitation_bars(raw_data)),
         "range": str(round(raw_data["daily"]["temperature_2m_min"][0]))
         + "—"
         + str(round(raw_data["daily"]["temperature_2m_max"][0]))
@@ -206,21 +313,112 @@ def fetch_data(
         "TEMPUNIT": TEMPUNIT,
         "WINDUNIT": WINDUNIT,
         "description": description,
-        "image_url": image_url,
+        "image_url": weather_icon(image_url),
         "location": location,
     }
 
     return data
 
 
-def make_weather_image():
-    data = fetch_data(
-        latitude=37.87159,
-        longitude=-122.27275,
-        location="Berkeley, CA",
-        temperature_unit="fahrenheit",
+def precipitation_bars(raw_data: dict) -> List[float]:
+    """The precipitation forecast for PRECIPITATION_HOURS from the
+    current hour, summed into CHART_BARS bars."""
+    hourly = raw_data["hourly"]
+    start = 0
+    now = raw_data["current_weather"].get("time")
+    if now is not None and "time" in hourly:
+        hours = [time[:13] for time in hourly["time"]]
+        if now[:13] in hours:
+            start = hours.index(now[:13])
+    # Missing hours are null, which becomes nan.
+    amounts = np.array(
+        hourly["precipitation"][start : start + PRECIPITATION_HOURS], "float"
     )
-    tmpdir = tempfile.TemporaryDirectory()
-    with open(os.path.join(tmpdir.name, "index.html"), "w") as f:
-        f.write(chevron.render(HTML_TEMPLATE, data))
-    return render_image(tmpdir)
+    amounts = np.pad(np.nan_to_num(amounts), (0, PRECIPITATION_HOURS - len(amounts)))
+    return np.round(amounts.reshape(CHART_BARS, -1).sum(axis=1), 1).tolist()
+
+
+def precipitation_chart(bars: List[float]) -> str:
+    """A chart of precipitation bars as a data URI, drawn in the
+    palette so that it is the same after dithering."""
+    key = state_etag(bars)
+    uri = CHARTS.get(key)
+    if uri is MISSING:
+        with metrics.timed("chart"):
+            chart = draw.draw_precipitation(bars)
+            uri = data_uri(encode_indexed_png(np.array(chart)))
+        CHARTS.set(key, uri)
+    return uri
+
+
+def weather_data(location: Location) -> dict:
+    return fetch_data(
+        latitude=location.latitude,
+        longitude=location.longitude,
+        location=location.name,
+        temperature_unit=location.temperature_unit,
+        windspeed_unit=location.windspeed_unit,
+    )
+
+
+def make_weather_html(location: Location):
+    return chevron.render(HTML_TEMPLATE, weather_data(location))
+
+
+def dither_icon(data: bytes) -> bytes:
+    """Flatten an icon onto white at the size it is shown and dither
+    it, as a PNG."""
+    icon = Image.open(io.BytesIO(data)).convert("RGBA")
+    icon.thumbnail(ICON_SIZE)
+    icon = Image.alpha_composite(Image.new("RGBA", icon.size, "white"), icon)
+    return encode_png(dither_image(icon))
+
+
+def weather_icon(url: str) -> Optional[str]:
+    """A weather icon dithered for the frame, as a data URI, so that
+    rendering needs no requests. Icons bundled with the package, named
+    like the end of their url, are used if there are any; the rest are
+    downloaded once and kept in ICON_STORE. Returns None if the icon
+    cannot be downloaded, and it is left out."""
+    uri = ICONS.get(url)
+    if uri is MISSING:
+        dithered = ICON_STORE.get(url)
+        if dithered is None:
+            name = url.rsplit("/", 1)[-1]
+            if importlib.resources.is_resource("framey", name):
+                original = importlib.resources.read_binary("framey", name)
+            else:
+                metrics.upstream("icon")
+                try:
+                    with metrics.timed("icon_download"):
+                        response = SESSION.get(url, timeout=TIMEOUT)
+                        response.raise_for_status()
+                except requests.RequestException:
+                    return None
+                original = response.content
+            with metrics.timed("icon_dither"):
+                dithered = dither_icon(original)
+            ICON_STORE.set(url, dithered)
+        uri = data_uri(dithered)
+        ICONS.set(url, uri)
+    return uri
+
+
+def weather_state(location: Location, renderer: str = "chrome"):
+    """Return an ETag for the weather image and a function to render
+    it, with Chrome or Pillow. The data is cheap to fetch and
+    determines the image, so it serves as the state."""
+    with metrics.timed("html"):
+        data = weather_data(location)
+    if renderer == "pillow":
+        return state_etag(renderer, data), image_renderer(
+            lambda: draw.draw_weather(data, draw.decode_data_uri(data["image_url"]))
+        )
+    html = chevron.render(HTML_TEMPLATE, data)
+    return state_etag(html), html_renderer(lambda: html)
+
+
+def make_weather_image(location: Location = None):
+    if location is None:
+        location = next(iter(LOCATIONS.values()))
+    return render_html(make_weather_html(location))
@@ -1,14 +1,74 @@
+import base64
 import importlib.resources
+import io
 import os
-import tempfile
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import replace
+from types import SimpleNamespace
 
+import numpy as np
 import pytest
 import requests
 import requests_mock
+import spotipy
 from PIL import Image
 
-from framey import render_image, make_qrcode
-from framey.spotify import Album, make_html
+import framey
+from framey import (
+    PALETTE,
+    Profile,
+    QRCODE_CACHE,
+    SolidFill,
+    TileDitherer,
+    dither_image_int,
+    dither_indices,
+    encode_image,
+    encode_png,
+    fit_jpeg,
+    html_renderer,
+    make_qrcode,
+    render_html,
+)
+from framey import cards, draw, metrics, spotify
+from framey.browser import BrowserError, BrowserPool, chrome_available
+from framey.cache import MISSING, Cache, FileStore, LRUCache
+from framey.cards import make_spotify_cards
+from framey import scheduler
+from framey.scheduler import Job
+from framey.spotify import (
+    Album,
+    NowPlayingPoller,
+    album_context,
+    album_state,
+    discogs_enhance,
+    download_cover,
+    make_html,
+    now_playing_album,
+)
+from framey import weather
+from framey.spotify_api import SpotifyClient
+from framey.weather import Location, forecast, weather_state
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        spotify, "DISCOGS_CACHE", Cache(str(tmp_path / "discogs.sqlite"))
+    )
+    monkeypatch.setattr(spotify, "COVER_STORE", FileStore(str(tmp_path / "covers")))
+    monkeypatch.setattr(spotify, "RATE_LIMITS", Cache(str(tmp_path / "spotify.sqlite")))
+    monkeypatch.setattr(weather, "ICON_STORE", FileStore(str(tmp_path / "icons")))
+    monkeypatch.setattr(weather, "ICONS", LRUCache(maxsize=32))
+    monkeypatch.setattr(scheduler, "SHARED_DIR", str(tmp_path / "rendered"))
+    monkeypatch.setattr(
+        scheduler,
+        "RENDERED",
+        scheduler.RenderedStore(str(tmp_path / "rendered" / "rendered.sqlite")),
+    )
+    return tmp_path
 
 
 @pytest.fixture
@@ -25,15 +85,43 @@ def album():
 
 
 def test_make_qrcode():
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with importlib.resources.path("framey", "discogs.png") as image_path:
-            filename = make_qrcode(
-                "http://google.com/",
-                embed_image=Image.open(image_path),
-                color=(255, 255, 255),
-                tmpdir=tmpdir,
-            )
-            assert os.path.getsize(os.path.join(tmpdir, filename)) > 1
+    with importlib.resources.path("framey", "discogs.png") as image_path:
+        uri = make_qrcode(
+            "http://google.com/",
+            embed_image=Image.open(image_path),
+            color=(255, 255, 255),
+        )
+    assert uri.startswith("data:image/png;base64,")
+    image = Image.open(io.BytesIO(base64.b64decode(uri.split(",", 1)[1])))
+    assert image.size[0] > 1
+
+
+def test_solid_fill_matches_qrcode():
+    import qrcode
+    from qrcode.image.styledpil import StyledPilImage
+    from qrcode.image.styles.colormasks import SolidFillColorMask
+
+    embed_image = spotify.logo("discogs.png")
+    images = []
+    for mask in [SolidFill((0, 255, 0)), SolidFillColorMask(front_color=(0, 255, 0))]:
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, border=0)
+        qr.add_data("http://example.org")
+        images.append(
+            qr.make_image(
+                image_factory=StyledPilImage, embeded_image=embed_image, color_mask=mask
+            ).get_image()
+        )
+    assert np.array_equal(np.array(images[0]), np.array(images[1]))
+
+
+def test_make_qrcode_is_cached():
+    embed_image = Image.new("RGB", (10, 10))
+    misses = QRCODE_CACHE.misses
+    first = make_qrcode("http://example.com/", embed_image, (0, 0, 0))
+    hits = QRCODE_CACHE.hits
+    assert make_qrcode("http://example.com/", embed_image, (0, 0, 0)) == first
+    assert QRCODE_CACHE.hits == hits + 1
+    assert QRCODE_CACHE.misses == misses + 1
 
 
 def test_render_image(requests_mock, album):
@@ -43,6 +131,741 @@ def test_render_image(requests_mock, album):
             body=open(path, "rb"),
         )
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        image = render_image(make_html(album))
-        assert image.size == (800, 480)
+    image = render_html(make_html(album))
+    assert image.size == (800, 480)
+
+
+@pytest.fixture
+def raw_forecast():
+    return {
+        "current_weather": {
+            "temperature": 61.3,
+            "windspeed": 9.8,
+            "weathercode": 2,
+            "is_day": 1,
+        },
+        "hourly": {"precipitation": [0.0] * 168},
+        "daily": {
+            "temperature_2m_max": [66.2],
+            "temperature_2m_min": [50.1],
+            "sunrise": ["2023-06-01T05:47"],
+            "sunset": ["2023-06-01T20:25"],
+        },
+        "daily_units": {"temperature_2m_max": "°F", "windspeed_10m_max": "km/h"},
+    }
+
+
+@pytest.fixture(autouse=True)
+def forecasts(monkeypatch):
+    monkeypatch.setattr(weather, "FORECASTS", {})
+    return weather.FORECASTS
+
+
+BERKELEY = Location("Berkeley, CA", 37.87159, -122.27275, "fahrenheit")
+OAKLAND = Location("Oakland, CA", 37.80437, -122.2708, "fahrenheit")
+
+
+def test_weather_state(requests_mock, forecasts, raw_forecast):
+    requests_mock.get("https://api.open-meteo.com/v1/forecast", json=raw_forecast)
+    # Without its icon, the weather is shown all the same.
+    requests_mock.get(weather.CODES[2]["day"][1], status_code=404)
+    etag, render = weather_state(BERKELEY)
+    assert weather_state(BERKELEY)[0] == etag
+    raw_forecast["current_weather"]["temperature"] = 71.1
+    forecasts.clear()
+    assert weather_state(BERKELEY)[0] != etag
+
+
+def test_weather_icon_is_downloaded_once(monkeypatch, requests_mock, raw_forecast):
+    requests_mock.get("https://api.open-meteo.com/v1/forecast", json=raw_forecast)
+    icon_url = weather.CODES[2]["day"][1]
+    icon = Image.new("RGBA", (200, 200), (255, 128, 0, 128))
+    requests_mock.get(icon_url, content=encode_png(icon))
+    html = weather.make_weather_html(BERKELEY)
+    # Rendering the page makes no requests.
+    assert "http" not in html
+    # The dithered icon survives a restart.
+    monkeypatch.setattr(weather, "ICONS", LRUCache(maxsize=32))
+    assert weather.make_weather_html(BERKELEY) == html
+    assert [r.url for r in requests_mock.request_history].count(icon_url) == 1
+    icon = draw.decode_data_uri(weather.weather_icon(icon_url))
+    colours = np.unique(np.array(icon.convert("RGB")).reshape(-1, 3), axis=0)
+    assert {tuple(c) for c in colours} <= {tuple(c) for c in PALETTE}
+
+
+def test_precipitation_chart(raw_forecast):
+    raw_forecast["current_weather"]["time"] = "2023-06-01T02:00"
+    raw_forecast["hourly"] = {
+        "time": [f"2023-06-0{1 + h // 24}T{h % 24:02}:00" for h in range(48)],
+        "precipitation": [0.0] * 48,
+    }
+    raw_forecast["hourly"]["precipitation"][2:5] = [1.0, 1.0, None]
+    raw_forecast["hourly"]["precipitation"][25] = 0.5
+    bars = weather.precipitation_bars(raw_forecast)
+    assert bars == [2.0] + [0.0] * 10 + [0.5]
+    misses = weather.CHARTS.misses
+    uri = weather.precipitation_chart(bars)
+    assert weather.precipitation_chart(list(bars)) == uri
+    assert weather.CHARTS.misses == misses + 1
+    # Drawn in the palette, the chart is unchanged by dithering.
+    chart = draw.decode_data_uri(uri)
+    assert np.array_equal(dither_indices(chart), np.array(chart))
+
+
+def test_forecasts_are_batched_and_cached(monkeypatch, requests_mock, raw_forecast):
+    monkeypatch.setattr(weather, "LOCATIONS", {"b": BERKELEY, "o": OAKLAND})
+    requests_mock.get(
+        "https://api.open-meteo.com/v1/forecast", json=[raw_forecast, raw_forecast]
+    )
+    forecast(OAKLAND)
+    forecast(BERKELEY)
+    forecast(OAKLAND)
+    assert requests_mock.call_count == 1
+    assert requests_mock.last_request.qs["latitude"] == ["37.80437,37.87159"]
+
+
+@pytest.fixture
+def cover():
+    with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+        return Image.open(path).convert("RGB")
+
+
+def test_dither_image_int_uses_palette(cover):
+    dithered = np.array(dither_image_int(cover)).reshape(-1, 3)
+    assert cover.size == dither_image_int(cover).size
+    assert {tuple(c) for c in np.unique(dithered, axis=0)} <= {
+        tuple(c) for c in PALETTE
+    }
+
+
+def test_tile_ditherer_matches_full_dither(cover):
+    ditherer = TileDitherer(tile=16, threads=2)
+    # Edge tiles are partial.
+    cover = cover.resize((100, 70))
+    assert np.array_equal(ditherer.dither(cover), dither_indices(cover))
+    changed = cover.copy()
+    changed.paste((255, 0, 0), (20, 30, 37, 45))
+    hits = (
+        "framey_cache_requests_total",
+        (("cache", "dither_tile"), ("result", "hit")),
+    )
+    before = metrics.COUNTERS[hits]
+    assert np.array_equal(ditherer.dither(changed), dither_indices(changed))
+    # Only the four of 7 by 5 tiles the change touched are dithered.
+    assert metrics.COUNTERS[hits] == before + 7 * 5 - 4
+
+
+def test_encode_image_formats(cover):
+    bodies, jpeg = encode_image(cover)
+    assert jpeg is None
+    indices = dither_indices(cover)
+    assert np.array_equal(np.array(Image.open(io.BytesIO(bodies["png"]))), indices)
+    raw = np.frombuffer(bodies["raw"], "uint8").reshape(cover.size[1], -1)
+    assert np.array_equal(raw >> 4, indices[:, 0::2])
+    assert np.array_equal(raw & 0x0F, indices[:, 1::2])
+    assert Image.open(io.BytesIO(bodies["jpeg"])).format == "JPEG"
+
+
+def test_fit_jpeg(cover):
+    budget = 40000
+    data, settings = fit_jpeg(cover, budget)
+    assert settings["bytes"] == len(data) <= budget
+    bigger = fit_jpeg(cover, budget, dict(settings, quality=settings["quality"] + 1))
+    assert bigger[1]["quality"] == settings["quality"]
+    _, tiny = fit_jpeg(cover, 100)
+    assert tiny["quality"] == 1 and tiny["bytes"] > 100
+
+
+def test_jpeg_budget_per_profile(monkeypatch):
+    monkeypatch.setattr(framey, "JPEG_BUDGET", 40000)
+    monkeypatch.setenv("FRAMEY_JPEG_BUDGET_5_7", "20000")
+    monkeypatch.setenv("FRAMEY_JPEG_BUDGET_4_0", "0")
+    assert framey.jpeg_budget("7.3") == 40000
+    assert framey.jpeg_budget("5.7") == 20000
+    assert framey.jpeg_budget("4.0") is None
+
+
+def test_dither_image_int_matches_hitherdither(cover):
+    hitherdither = pytest.importorskip("hitherdither")
+    palette = hitherdither.palette.Palette(
+        [0x000000, 0xFFFFFF, 0x00FF00, 0x0000FF, 0x00FF00, 0xFFFF00, 0xFF8000]
+    )
+    for image in [
+        cover,
+        Image.fromarray(np.random.RandomState(0).randint(0, 256, (61, 83, 3), "uint8")),
+    ]:
+        expected = hitherdither.ordered.bayer.bayer_dithering(
+            image, palette, [256 / 4, 256 / 4, 256 / 4], order=8
+        ).convert("RGB")
+        assert np.array_equal(np.array(dither_image_int(image)), np.array(expected))
+
+
+class FakeBrowser:
+    started = 0
+
+    def __init__(self):
+        FakeBrowser.started += 1
+        self.renders = 0
+        self.closed = False
+        self.crash = False
+
+    def alive(self):
+        return not self.closed
+
+    def screenshot(self, url, size, html=None, scale=1):
+        if self.crash:
+            raise BrowserError("crashed")
+        self.renders += 1
+        return url.encode()
+
+    def close(self):
+        self.closed = True
+
+
+def test_browser_pool_reuses_and_recycles():
+    FakeBrowser.started = 0
+    pool = BrowserPool(size=1, max_renders=2, factory=FakeBrowser)
+    assert pool.screenshot("a", (800, 480)) == b"a"
+    assert pool.screenshot("b", (800, 480)) == b"b"
+    assert FakeBrowser.started == 1
+    pool.screenshot("c", (800, 480))
+    assert FakeBrowser.started == 2
+
+
+def test_browser_pool_closes_its_browsers():
+    pool = BrowserPool(size=2, factory=FakeBrowser)
+    with pool.browser() as idle:
+        pass
+    with pool.browser() as in_use:
+        assert in_use is idle
+        with pool.browser() as other:
+            pool.close()
+    assert idle.closed and other.closed
+    with pool.browser() as browser:
+        assert browser not in (idle, other)
+
+
+def test_browser_pool_restarts_crashed_browser():
+    FakeBrowser.started = 0
+    pool = BrowserPool(size=1, factory=FakeBrowser)
+    pool.screenshot("a", (800, 480))
+    with pool.browser() as browser:
+        browser.crash = True
+    assert pool.screenshot("b", (800, 480)) == b"b"
+    assert FakeBrowser.started == 2
+
+
+class ScaledBrowser(FakeBrowser):
+    def screenshot(self, url, size, html=None, scale=1):
+        self.renders += 1
+        width, height = round(size[0] * scale), round(size[1] * scale)
+        return encode_png(Image.new("RGB", (width, height), "black"))
+
+
+def test_html_renderer_shares_html_between_profiles(monkeypatch):
+    monkeypatch.setattr(framey, "BROWSER_POOL", BrowserPool(factory=ScaledBrowser))
+    builds = []
+    render = html_renderer(lambda: builds.append(1) or "<p>hi</p>")
+    image = render(Profile(600, 448))
+    assert image.size == (600, 448)
+    # Scaled to 600x360 and centred, with white above and below.
+    assert image.getpixel((0, 43)) == (255, 255, 255)
+    assert image.getpixel((0, 44)) == (0, 0, 0)
+    assert render(Profile(800, 480)).size == (800, 480)
+    assert builds == [1]
+
+
+def test_pillow_renderer_draws_album(monkeypatch, album, cover):
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", FakeDiscogs())
+    album.cover = cover
+    etag, render = album_state(album, renderer="pillow")
+    assert etag != album_state(album)[0]
+    image = render(Profile(600, 448))
+    assert image.size == (600, 448)
+    assert image.getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_pillow_renderer_matches_chrome(album, cover):
+    if not chrome_available():
+        pytest.skip("Chrome is not installed")
+    album.cover = cover
+    album.credits = [{"name": "Someone", "role": "Producer"}]
+    context = album_context(album)
+    drawn = draw.draw_album(context).convert("L")
+    rendered = render_html(make_html(album)).convert("L")
+    # Boxes of the template, each compared on its own so that the cover
+    # cannot outweigh the rest.
+    for box in [(0, 0, 480, 480), (490, 10, 635, 155), (645, 10, 790, 155)]:
+        difference = np.array(drawn.crop(box), "float") - rendered.crop(box)
+        assert np.abs(difference).mean() < 16, box
+    # Text is set in other fonts, so its ink is compared instead: it
+    # should cover much the same lines and amount of the info box.
+    info = (480, 155, 800, 480)
+    drawn_ink, rendered_ink = [
+        np.array(image.crop(info)) < 128 for image in (drawn, rendered)
+    ]
+    assert drawn_ink.any() and rendered_ink.any()
+    for axis in (0, 1):
+        drawn_extent, rendered_extent = [
+            np.flatnonzero(ink.any(axis=axis))[[0, -1]]
+            for ink in (drawn_ink, rendered_ink)
+        ]
+        assert np.abs(drawn_extent - rendered_extent).max() <= 20
+    assert 0.5 < drawn_ink.sum() / rendered_ink.sum() < 2
+
+
+def test_job_serves_stale_image_while_refreshing():
+    renders = []
+    etag = ["a"]
+
+    def render(profile):
+        renders.append(etag[0])
+        return Image.new("RGB", (16, 16))
+
+    job = Job("test", lambda: (etag[0], render), interval=60)
+    first = job.get()
+    assert first.etag == "a" and first.bodies["7.3"]["jpeg"]
+    job.refresh()
+    assert renders == ["a"]
+
+    etag[0] = "b"
+    job.interval = 0
+    stale = job.rendered
+    started = time.monotonic()
+    assert job.get() is stale
+    assert time.monotonic() - started < 0.05
+    for _ in range(100):
+        if job.rendered.etag == "b":
+            break
+        time.sleep(0.01)
+    assert renders == ["a", "b"]
+
+
+def test_job_records_stage_timings():
+    job = Job(
+        "test", lambda: ("a", lambda profile: Image.new("RGB", (16, 16))), interval=60
+    )
+    timings = job.get().timings
+    assert {"state", "dither", "encode"} <= set(timings)
+    assert metrics.server_timing({"dither": 0.0123}) == "dither;dur=12.3"
+    with pytest.raises(ValueError), metrics.timed("failing"):
+        raise ValueError()
+    exposition = metrics.exposition()
+    assert 'framey_stage_seconds_count{stage="dither"}' in exposition
+    assert 'framey_stage_errors_total{stage="failing"} 1.0' in exposition
+    assert 'framey_cache_requests_total{cache="qrcode",result="hit"}' in exposition
+
+
+def test_cache(tmp_path):
+    cache = Cache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    assert cache.get("a") is MISSING
+    cache.set("a", None, ttl=60)
+    assert cache.get("a") is None
+    cache.set("b", [1, "2"], ttl=60)
+    assert cache.get("b") == [1, "2"]
+    cache.set("c", 3, ttl=-1)
+    assert cache.get("c") is MISSING
+    cache.set("d", 4, ttl=60)
+    assert cache.get("a") is MISSING
+    assert Cache(cache.path).get("d") == 4
+
+
+class FakeDiscogs:
+    def __init__(self):
+        self.searches = 0
+
+    def search(self, query, type):
+        self.searches += 1
+        if type == "master":
+            return []
+        credit = SimpleNamespace(name="Someone", role="Producer")
+        return [SimpleNamespace(credits=[credit], url="http://d/1")]
+
+
+def test_discogs_enhance_is_cached(monkeypatch, album):
+    discogs = FakeDiscogs()
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", discogs)
+    for _ in range(2):
+        album.credits = album.discogs_url = None
+        discogs_enhance(album)
+        assert album.credits == [{"name": "Someone", "role": "Producer"}]
+        assert album.discogs_url == "http://d/1"
+    assert discogs.searches == 2
+
+
+def test_hung_discogs_does_not_hold_up_covers(monkeypatch, requests_mock, album):
+    with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+        requests_mock.get(album.cover, body=open(path, "rb"))
+    released = threading.Event()
+    hung = SimpleNamespace(search=lambda query, type: released.wait())
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", hung)
+    monkeypatch.setattr(spotify, "DISCOGS_TIMEOUT", 0.01)
+    monkeypatch.setattr(spotify, "STAGE_TIMEOUT", 5)
+    try:
+        # More lookups hang than there are threads for the stages.
+        for _ in range(6):
+            assert album_context(album, enhance=True)["cover"]
+    finally:
+        released.set()
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", None)
+    timeouts = spotify.discogs()._fetcher
+    assert timeouts.connect_timeout == timeouts.read_timeout == framey.TIMEOUT
+
+
+class FakeLibrary:
+    """Saved albums, failing once at fail_at like an interrupted run."""
+
+    def __init__(self, albums: int, fail_at=None):
+        self.albums = albums
+        self.fail_at = fail_at
+        self.offsets = []
+
+    def current_user_saved_albums(self, limit, offset):
+        if offset == self.fail_at:
+            self.fail_at = None
+            raise requests.ConnectionError()
+        self.offsets.append(offset)
+        items = [
+            {
+                "album": {
+                    "images": [{"url": "http://example.com/cover.jpeg"}],
+                    "artists": [{"name": "Daniel Case"}],
+                    "name": f"Album {i}",
+                    "release_date": "2000",
+                    "external_urls": {"spotify": f"http://example.org/{i}"},
+                }
+            }
+            for i in range(offset, min(offset + limit, self.albums))
+        ]
+        more = offset + limit < self.albums
+        return {"items": items, "next": "more" if more else None}
+
+
+def fake_make_card(album, path, renderer):
+    with open(path, "w") as f:
+        f.write(album.title)
+
+
+def test_make_cards_resumes_and_skips_made_cards(monkeypatch, tmp_path):
+    monkeypatch.setattr(cards, "PAGE_SIZE", 2)
+    monkeypatch.setattr(cards, "make_card", fake_make_card)
+    library = FakeLibrary(5, fail_at=4)
+    monkeypatch.setattr(spotify, "spotify_client", lambda: library)
+    directory = str(tmp_path / "cards")
+    with pytest.raises(requests.ConnectionError):
+        make_spotify_cards(directory, renderer="pillow", workers=2)
+    assert cards.read_progress(directory) == {"spotify": 2}
+    # The page in flight when the run stopped is made but not recorded,
+    # so its cards are skipped on resuming.
+    assert make_spotify_cards(directory, renderer="pillow", workers=2) == 1
+    assert library.offsets == [0, 2, 2, 4]
+    assert len([name for name in os.listdir(directory) if name.endswith(".png")]) == 5
+    assert cards.read_progress(directory) == {}
+    assert make_spotify_cards(directory, renderer="pillow", workers=2) == 0
+
+
+def test_make_card_saves_dithered_png(monkeypatch, tmp_path, album, cover):
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", FakeDiscogs())
+    album.cover = cover
+    (tmp_path / "cards").mkdir()
+    cards.make_card(album, str(tmp_path / "cards" / "card.png"), "pillow")
+    card = Image.open(str(tmp_path / "cards" / "card.png"))
+    assert card.mode == "P" and card.size == (800, 480)
+    assert os.listdir(str(tmp_path / "cards")) == ["card.png"]
+
+
+def test_download_cover_is_stored(requests_mock, album):
+    with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+        requests_mock.get("http://example.com/cover.jpeg", body=open(path, "rb"))
+    uri = download_cover(album)
+    assert uri.startswith("data:image/png;base64,")
+    assert download_cover(album) == uri
+    assert requests_mock.call_count == 1
+
+
+def test_file_store_evicts_least_recently_used(tmp_path):
+    store = FileStore(str(tmp_path), max_bytes=10)
+    store.set("a", b"aaaa")
+    store.set("b", b"bbbb")
+    os.utime(store._file("b"), (0, 0))
+    store.get("a")
+    store.set("c", b"cccc")
+    assert store.get("a") == b"aaaa"
+    assert store.get("b") is None
+    assert store.get("c") == b"cccc"
+
+
+def test_make_html_without_discogs(monkeypatch, requests_mock, album):
+    def fail(query, type):
+        raise requests.ConnectionError()
+
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", SimpleNamespace(search=fail))
+    with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+        requests_mock.get("http://example.com/cover.jpeg", body=open(path, "rb"))
+    album.credits = album.discogs_url = None
+    html = make_html(album, enhance=True)
+    assert "data:image/png;base64," in html
+    assert "discogs qrcode" not in html
+
+
+def test_now_playing_album_is_one_call(monkeypatch, requests_mock):
+    calls = []
+    monkeypatch.setattr(spotify, "CALL_HOOKS", [lambda *call: calls.append(call)])
+    requests_mock.get(
+        "https://api.spotify.com/v1/me/player/currently-playing",
+        json={
+            "is_playing": True,
+            "item": {
+                "album": {
+                    "images": [{"url": "http://example.com/cover.jpeg"}],
+                    "artists": [{"name": "Daniel Case"}],
+                    "name": "Engigstciak",
+                    "release_date": "2000-01-01",
+                    "external_urls": {"spotify": "http://example.org"},
+                }
+            },
+        },
+    )
+    album = now_playing_album(SpotifyClient(auth="token"))
+    assert album.title == "Engigstciak"
+    assert calls == [("GET", "me/player/currently-playing")]
+
+
+def test_job_coalesces_concurrent_renders():
+    states = []
+
+    def state():
+        states.append(1)
+        time.sleep(0.1)
+        return "a", lambda profile: Image.new("RGB", (16, 16))
+
+    job = Job("test", state, interval=60)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(job.get())) for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(states) == 1
+    assert all(result is results[0] for result in results)
+
+    # Another process with the same job takes up the published image.
+    other = Job("test", lambda: pytest.fail("state checked twice"), interval=60)
+    assert other.get().bodies == results[0].bodies
+
+
+def test_job_renders_again_for_changed_profiles(monkeypatch):
+    renders = []
+
+    def render(profile):
+        renders.append(profile.size)
+        return Image.new("RGB", profile.size)
+
+    def state():
+        return "a", render
+
+    small = framey.ALL_PROFILES["5.7"]
+    monkeypatch.setattr(scheduler, "PROFILES", {"7.3": framey.ALL_PROFILES["7.3"]})
+    Job("test", state, interval=60).get()
+    # Restarted with another profile, the stored image is not enough.
+    monkeypatch.setattr(
+        scheduler, "PROFILES", dict(scheduler.PROFILES, **{"5.7": small})
+    )
+    assert set(Job("test", state, interval=60).get().bodies) == {"7.3", "5.7"}
+    assert renders == [(800, 480), (800, 480), (600, 448)]
+    # As with another budget.
+    budgeted = replace(small, jpeg_budget=20000)
+    monkeypatch.setattr(
+        scheduler, "PROFILES", dict(scheduler.PROFILES, **{"5.7": budgeted})
+    )
+    assert Job("test", state, interval=60).get().jpeg["5.7"]["bytes"] <= 20000
+    assert len(renders) == 5
+
+
+def test_rendered_store_evicts(tmp_path):
+    store = scheduler.RenderedStore(str(tmp_path / "rendered.sqlite"), max_bytes=10)
+    store.put("a", scheduler.Rendered("1", {"7.3": {"raw": b"aaaaaa"}}, 1.0))
+    store.put("b", scheduler.Rendered("2", {"7.3": {"raw": b"bbbbbb"}}, 2.0))
+    assert store.get("a") is None
+    assert store.get("b") == scheduler.Rendered("2", {"7.3": {"raw": b"bbbbbb"}}, 2.0)
+
+
+def test_job_writes_image_only_when_rendered(monkeypatch):
+    puts = []
+    put = scheduler.RENDERED.put
+    monkeypatch.setattr(
+        scheduler.RENDERED, "put", lambda *args: puts.append(1) or put(*args)
+    )
+    job = Job(
+        "test", lambda: ("a", lambda profile: Image.new("RGB", (16, 16))), interval=0
+    )
+    first = job.get()
+    job.refresh(wait=True)
+    assert puts == [1]
+    stored = scheduler.RENDERED.get("test")
+    assert stored.checked == job.rendered.checked > first.checked
+    assert stored.bodies == first.bodies
+
+
+class FakeSpotify:
+    def __init__(self):
+        self.playing = True
+        self.rate_limited = False
+        self.calls = 0
+
+    def current_user_playing_track(self):
+        self.calls += 1
+        if self.rate_limited:
+            raise spotipy.SpotifyException(
+                429, -1, "Too many requests", headers={"Retry-After": "30"}
+            )
+        return {
+            "is_playing": self.playing,
+            "item": {
+                "album": {
+                    "images": [{"url": "http://example.com/cover.jpeg"}],
+                    "artists": [{"name": "Daniel Case"}],
+                    "name": "Engigstciak",
+                    "release_date": "2000",
+                    "external_urls": {"spotify": "http://example.org"},
+                }
+            },
+        }
+
+
+def test_now_playing_poller(monkeypatch):
+    client = FakeSpotify()
+    monkeypatch.setattr(spotify, "spotify_client", lambda: client)
+    poller = NowPlayingPoller(playing_interval=10, idle_interval=60)
+    etag, _ = poller.state()
+    assert poller.interval == 10
+    client.playing = False
+    assert poller.state()[0] == etag
+    assert poller.interval == 20
+    poller.state()
+    poller.state()
+    assert poller.interval == 60
+    client.rate_limited = True
+    with pytest.raises(spotipy.SpotifyException):
+        poller.state()
+    assert poller.interval == 30
+    # Spotify is not called again until Retry-After has passed.
+    calls = client.calls
+    assert poller.state()[0] == etag
+    assert client.calls == calls
+    later = time.time() + 31
+    monkeypatch.setattr(time, "time", lambda: later)
+    with pytest.raises(spotipy.SpotifyException):
+        poller.state()
+    assert client.calls == calls + 1
+
+
+def test_now_playing_pollers_share_rate_limits(monkeypatch):
+    client = FakeSpotify()
+    monkeypatch.setattr(spotify, "spotify_client", lambda: client)
+    # Pollers of two server processes.
+    limited, other = NowPlayingPoller(), NowPlayingPoller()
+    etag, _ = limited.state()
+    client.rate_limited = True
+    with pytest.raises(spotipy.SpotifyException):
+        limited.state()
+    calls = client.calls
+    assert other.state()[0] == etag
+    assert client.calls == calls
+
+
+def test_now_playing_album_is_rendered_once(monkeypatch, requests_mock):
+    with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+        requests_mock.get("http://example.com/cover.jpeg", body=open(path, "rb"))
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", FakeDiscogs())
+    monkeypatch.setattr(spotify, "spotify_client", FakeSpotify)
+    draws = []
+    draw_album = spotify.draw_album
+    monkeypatch.setattr(
+        spotify, "draw_album", lambda album: draws.append(1) or draw_album(album)
+    )
+    poller = NowPlayingPoller(renderer="pillow")
+    job = Job("playing", poller.state, interval=0)
+    job.refresh(wait=True)
+    etag = job.rendered.etag
+    job.refresh(wait=True)
+    assert job.rendered.etag == etag
+    assert draws == [1]
+
+
+def test_job_records_timings_of_executor_stages(monkeypatch, requests_mock, album):
+    with importlib.resources.path("framey", "sample-cover.jpeg") as path:
+        requests_mock.get(album.cover, body=open(path, "rb"))
+    monkeypatch.setattr(spotify, "DISCOGS_CLIENT", FakeDiscogs())
+    job = Job("album", lambda: album_state(album, "pillow"), interval=60)
+    timings = job.get().timings
+    assert {"discogs", "cover_download", "cover_dither"} <= set(timings)
+
+
+def test_server_imports_lazily(tmp_path):
+    lazy = ["qrcode", "discogs_client", "spotipy", "websocket"]
+    code = f"import sys, framey.server; print([m for m in {lazy} if m in sys.modules])"
+    env = dict(os.environ, FRAMEY_CACHE_DIR=str(tmp_path))
+    output = subprocess.check_output([sys.executable, "-c", code], env=env)
+    assert output.strip() == b"[]"
+
+
+def test_version_reports_images_rendered_elsewhere(monkeypatch):
+    from framey import server
+
+    # Started, so that the jobs are not refreshed in the background.
+    monkeypatch.setattr(server.SCHEDULER, "_pid", os.getpid())
+    for job in server.SCHEDULER.jobs.values():
+        monkeypatch.setattr(job, "rendered", None)
+    scheduler.RENDERED.put(
+        "playing",
+        scheduler.Rendered("a", None, time.time(), profiles=scheduler.PROFILES),
+    )
+    versions = server.app.test_client().get("/version").json
+    assert versions.pop("playing") == "a"
+    assert set(versions.values()) == {None}
+
+
+def test_ready_after_warm_up(monkeypatch):
+    from framey import server
+
+    steps = []
+    monkeypatch.setattr(server, "warm_up_steps", lambda: {"a": lambda: steps.append(1)})
+    monkeypatch.setattr(server, "_warm_up_pid", None)
+    client = server.app.test_client()
+    assert client.get("/ready").status_code == 503
+    for _ in range(100):
+        response = client.get("/ready")
+        if response.status_code == 200:
+            break
+        time.sleep(0.01)
+    assert response.json == {"ready": True, "warm_up": {"a": "ok"}}
+    assert steps == [1]
+
+
+def test_ready_retries_failed_warm_up_steps(monkeypatch):
+    from framey import server
+
+    steps = []
+
+    def flaky():
+        steps.append(1)
+        if len(steps) == 1:
+            raise RuntimeError("Chrome took too long")
+
+    monkeypatch.setattr(
+        server, "warm_up_steps", lambda: {"a": lambda: None, "flaky": flaky}
+    )
+    monkeypatch.setattr(server, "_warm_up_pid", None)
+    server.warm_up()
+    assert server.WARM_UP["flaky"] == "RuntimeError('Chrome took too long')"
+    client = server.app.test_client()
+    for _ in range(100):
+        response = client.get("/ready")
+        if response.status_code == 200:
+            break
+        time.sleep(0.01)
+    assert response.json == {"ready": True, "warm_up": {"a": "ok", "flaky": "ok"}}
+    assert steps == [1, 1]